@@ -82,6 +82,8 @@ class EasyDeLBaseModule(
 	base_model_prefix: str
 	_model_task: tp.Optional[str] = None
 	_model_type: tp.Optional[str] = None
+	# fused linear name -> `(torch linear, out features)` pairs it replaces.
+	_fused_linears: tp.Optional[tp.Mapping[str, tp.Tuple[tp.Tuple[str, int], ...]]] = None
 
 	def __init__(
 		self,
@@ -122,6 +124,18 @@ class EasyDeLBaseModule(
 			parameters[key] = value.value
 		return parameters
 
+	@property
+	def _stacked_layers(self) -> tp.Tuple[tuple, ...]:
+		"""Paths of the block lists stored stacked along a leading layer axis."""
+		from easydel.utils.graph_utils import iter_module_search
+
+		return tuple(
+			path
+			for path, module in iter_module_search(self)
+			# `nn.Rngs` answers any attribute, so only an actual layer count counts.
+			if isinstance(getattr(module, "num_stacked_layers", None), int)
+		)
+
 	@property
 	def graphtree_params_shape(self) -> tp.Dict:
 		"""Evaluates the shape of the model's parameters and returns a dictionary."""
@@ -339,7 +353,16 @@ class EasyDeLBaseModule(
 					"Partition rules must be provided either as an argument or through the model config."
 				)
 
-			return self.config.get_partition_rules(fully_sharded_data_parallel=True)
+			partition_rules = self.config.get_partition_rules(
+				fully_sharded_data_parallel=True
+			)
+		if (
+			getattr(getattr(self, "config", None), "quantization_method", None)
+			== EasyDeLQuantizationMethods.NF4
+		):
+			from easydel.layers.quantization import LinearNF4
+
+			partition_rules = LinearNF4.derive_partition_rules(partition_rules)
 		return partition_rules
 
 	def _apply_sharding_fns(
@@ -610,6 +633,8 @@ class EasyDeLBaseModule(
 			embedding_layer_names=embedding_path,
 			layernorm_names=layernorm_path,
 			dtype=self.param_dtype,
+			fused_linears=self._fused_linears,
+			stacked_layers=self._stacked_layers,
 			shard_fns=self._shard_fns,
 		)
 
@@ -622,8 +647,11 @@ class EasyDeLBaseModule(
 
 	def merge_params(self, tree):
 		"""merge state to the current model"""
+		from easydel.layers.quantization import LinearNF4
+
 		gdef, _, gother = nn.split(self, nn.Param, ...)
 		self = nn.merge(gdef, tree, gother)
+		LinearNF4.refresh_dequant_caches(self)
 		return self
 
 	def split_params(self):
@@ -704,6 +732,8 @@ class EasyDeLBaseModule(
 			embedding_layer_names=embedding_path,
 			layernorm_names=layernorm_path,
 			dtype=self.param_dtype,
+			fused_linears=self._fused_linears,
+			stacked_layers=self._stacked_layers,
 		)
 
 	@property
@@ -50,6 +50,7 @@ class EasyDeLGradientCheckPointers(str, Enum):
 	NOTHING_SAVEABLE = "nothing_saveable"
 	CHECKPOINT_DOTS = "checkpoint_dots"
 	CHECKPOINT_DOTS_WITH_NO_BATCH_DMIS = "checkpoint_dots_with_no_batch_dims"
+	SAVE_MATMUL_OUTPUTS = "save_matmul_outputs"
 	NONE = ""
 
 
@@ -62,6 +63,8 @@ class EasyDeLQuantizationMethods(str, Enum):
 	NONE = None
 	NF4 = "nf4"
 	A8BIT = "8bit"
+	FP8 = "fp8"
+	TERNARY = "ternary"
 
 
 class EasyDeLPlatforms(str, Enum):
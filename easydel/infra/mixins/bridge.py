@@ -64,6 +64,16 @@ logger = get_logger(__name__)
 FLAX_WEIGHTS_NAME = "easydel-model.parameters"
 
 
+def _resolve_quantization_method(
+	config,
+	quantization_method: tp.Optional[EasyDeLQuantizationMethods],
+) -> tp.Optional[EasyDeLQuantizationMethods]:
+	"""`bits="fp8"` configs load their linears as `LinearFP8`, scaled once at load."""
+	if quantization_method is None and getattr(config, "bits", None) == "fp8":
+		return EasyDeLQuantizationMethods.FP8
+	return quantization_method
+
+
 class EasyBridgeMixin(PushToHubMixin):
 	"""
 	Mixin class for adding bridging functionalities like saving, loading, and pushing models to Hugging Face Hub.
@@ -486,6 +496,7 @@ class EasyBridgeMixin(PushToHubMixin):
 		if config_kwargs:
 			for k, v in config_kwargs.items():
 				setattr(config, k, v)
+		quantization_method = _resolve_quantization_method(config, quantization_method)
 
 		if commit_hash is None:
 			commit_hash = getattr(config, "_commit_hash", None)
@@ -709,6 +720,10 @@ class EasyBridgeMixin(PushToHubMixin):
 		if config_kwargs is not None:
 			for k, v in config_kwargs.items():
 				setattr(config_class, k, v)
+		quantization_method = _resolve_quantization_method(
+			config_class,
+			quantization_method,
+		)
 
 		logger.debug("creating easydel model")
 		model = module.lazy_init(
@@ -33,7 +33,8 @@ from eformer.escale import PartitionAxis, with_sharding_constraint
 from einops import rearrange
 from flax import nnx as nn
 from jax.core import Jaxpr
-from jax.sharding import PartitionSpec
+from jax.interpreters import pxla
+from jax.sharding import NamedSharding, PartitionSpec, SingleDeviceSharding
 from tqdm.auto import tqdm
 
 from easydel.utils.helpers import get_logger
@@ -124,6 +125,11 @@ def canonicalize_dtype(
 	return dtype
 
 
+# `checkpoint_name` tags placed on projection outputs; the `save_matmul_outputs`
+# policy keeps only these and recomputes norms, activations and attention scores.
+MATMUL_CHECKPOINT_NAMES = ("qkv_out", "attn_out", "mlp_up", "mlp_down")
+
+
 def get_gradient_checkpoint_policy(name):
 	"""
 	The get_gradient_checkpoint_policy function is a helper function that returns the gradient checkpoint policy
@@ -140,6 +146,9 @@ def get_gradient_checkpoint_policy(name):
 		save_any_names_but_these=jax.checkpoint_policies.save_any_names_but_these,
 		save_only_these_names=jax.checkpoint_policies.save_only_these_names,
 		save_from_both_policies=jax.checkpoint_policies.save_from_both_policies,
+		save_matmul_outputs=jax.checkpoint_policies.save_only_these_names(
+			*MATMUL_CHECKPOINT_NAMES
+		),
 	)
 	return gradients[name]
 
@@ -164,8 +173,30 @@ def add_start_docstrings(*docstr):
 	return docstring_decorator
 
 
+def float32_accumulate_dot_general(
+	lhs,
+	rhs,
+	dimension_numbers,
+	precision=None,
+	preferred_element_type=None,
+):
+	"""
+	`lax.dot_general` that accumulates in float32 and casts the result back to the
+	operands' dtype (or `preferred_element_type` when one is given), so bf16
+	operands keep their throughput without bf16 accumulation.
+	"""
+	out = jax.lax.dot_general(
+		lhs,
+		rhs,
+		dimension_numbers,
+		precision=precision,
+		preferred_element_type=jax.numpy.float32,
+	)
+	return out.astype(preferred_element_type or jax.numpy.result_type(lhs, rhs))
+
+
 def get_dot_general_by_bits(
-	bits: tp.Optional[int] = None,
+	bits: tp.Optional[tp.Union[int, tp.Literal["fp8"]]] = None,
 	mode: tp.Literal["train", "serve", "convert"] = EasyMethod.TRAIN,
 ) -> dict:
 	"""The get_general_dot function is a helper function that returns a q_flax.QDotGeneral object
@@ -173,13 +204,17 @@ def get_dot_general_by_bits(
 	the function returns None.
 
 	Args:
-	    bits: tp.Optional[int]: Specify the number of bits for quantization
+	    bits: tp.Optional[int]: Specify the number of bits for quantization, or
+	        `"fp8"`, whose linears are converted to `LinearFP8` at load time
 	    mode: EasyMethod: Specify the use of model to init the QDot
 	        Method for (e.q TRAIN,SERVE,...)
 
 	Returns:
-	    A dict that contain dot_general_cls
+	    A dict that contain dot_general_cls, or a float32-accumulating
+	    `dot_general` when no quantization is requested
 	"""
+	if bits is None or bits == "fp8":
+		return {"dot_general": float32_accumulate_dot_general}
 	if bits is not None:
 		try:
 			from aqt.jax.v2 import config as q_config
@@ -233,6 +268,97 @@ def block_wise_ffn(remat_ffn, inputs, chunk_size: int):
 		) from e
 
 
+def nested_scan(body, init, xs, group_size: int):
+	"""
+	`jax.lax.scan` over the leading axis of `xs` as `L // group_size` checkpointed
+	groups of `group_size` steps each.
+
+	Only the carries at group boundaries are kept for the backward pass and each
+	group is recomputed once, so with `group_size ~ sqrt(L)` activation memory
+	grows with `sqrt(L)` instead of `L`. Falls back to a flat scan, with a warning,
+	when the length is not a multiple of `group_size`.
+	"""
+	length = jax.tree_util.tree_leaves(xs)[0].shape[0]
+	if group_size <= 1 or group_size >= length:
+		return jax.lax.scan(body, init, xs)
+	if length % group_size != 0:
+		logger.warning(
+			f"`group_size={group_size}` does not divide the scan length {length}; "
+			"running a flat scan without grouped rematerialization."
+		)
+		return jax.lax.scan(body, init, xs)
+	grouped = jax.tree_util.tree_map(
+		lambda x: x.reshape(length // group_size, group_size, *x.shape[1:]),
+		xs,
+	)
+
+	@functools.partial(
+		jax.checkpoint,
+		policy=jax.checkpoint_policies.nothing_saveable,
+		prevent_cse=False,
+	)
+	def group_body(carry, group):
+		return jax.lax.scan(body, carry, group)
+
+	carry, ys = jax.lax.scan(group_body, init, grouped)
+	ys = jax.tree_util.tree_map(lambda y: y.reshape(length, *y.shape[2:]), ys)
+	return carry, ys
+
+
+def stack_layers(make_layer: tp.Callable, num_layers: int, rngs: nn.Rngs):
+	"""
+	Builds `num_layers` layers from `make_layer(rngs)` as a single module whose
+	params carry a leading layer axis, so a `lax.scan` can run over them as they
+	are stored instead of restacking (and copying) every weight on each call.
+	Non-param states such as the rngs stay shared by all layers.
+	"""
+
+	@nn.split_rngs(splits=num_layers)
+	@nn.vmap(in_axes=(0,), out_axes=0)
+	def _make(rngs):
+		return make_layer(rngs)
+
+	layers = _make(rngs)
+	# read back by `EasyDeLBaseModule._stacked_layers` when loading / exporting.
+	layers.num_stacked_layers = num_layers
+	return layers
+
+
+def layer_at(layers: nn.Module, idx: int) -> nn.Module:
+	"""Returns layer `idx` of a module built by `stack_layers`."""
+	graphdef, params, others = nn.split(layers, nn.Param, ...)
+	return nn.merge(graphdef, jax.tree_util.tree_map(lambda x: x[idx], params), others)
+
+
+def offload_to_host(
+	x: jax.Array,
+	partition_spec: PartitionSpec = PartitionSpec(),  # noqa: B008
+) -> jax.Array:
+	"""
+	Moves `x` into pinned host memory, inside or outside of `jit`, so rarely read
+	outputs stop competing with live activations for device memory. Concrete arrays
+	keep their sharding; traced ones are laid out with `partition_spec` over the
+	active mesh. A no-op on backends without a `pinned_host` memory space.
+	"""
+	devices = jax.local_devices()
+	if not all(
+		"pinned_host" in {memory.kind for memory in device.addressable_memories()}
+		for device in devices
+	):
+		return x
+	if isinstance(x, jax.Array) and not isinstance(x, jax.core.Tracer):
+		sharding = x.sharding.with_memory_kind("pinned_host")
+	else:
+		mesh = pxla.thread_resources.env.physical_mesh
+		if not mesh.empty:
+			sharding = NamedSharding(mesh, partition_spec, memory_kind="pinned_host")
+		elif len(devices) == 1:
+			sharding = SingleDeviceSharding(devices[0], memory_kind="pinned_host")
+		else:
+			return x
+	return jax.device_put(x, sharding)
+
+
 def control_mlp_sharding(x: jax.Array, partition_axis: PartitionAxis):
 	"""
 	handles MLP Shardings
@@ -292,7 +418,12 @@ def quantize_linear_layers(
 	if method == EasyDeLQuantizationMethods.NONE or method is None:
 		return model
 
-	from easydel.layers.quantization import Linear8bit, LinearNF4
+	from easydel.layers.quantization import (
+		Linear8bit,
+		LinearFP8,
+		LinearNF4,
+		LinearTernary,
+	)
 	from easydel.utils.graph_utils import (
 		get_module_from_path,
 		iter_module_search,
@@ -302,6 +433,8 @@ def quantize_linear_layers(
 	quantizer: Linear8bit = {
 		EasyDeLQuantizationMethods.NF4: LinearNF4,
 		EasyDeLQuantizationMethods.A8BIT: Linear8bit,
+		EasyDeLQuantizationMethods.FP8: LinearFP8,
+		EasyDeLQuantizationMethods.TERNARY: LinearTernary,
 		EasyDeLQuantizationMethods.A4Q: LinearNF4,
 		EasyDeLQuantizationMethods.A8Q: Linear8bit,
 	}.get(method, None)
@@ -0,0 +1,58 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+from flax import nnx as nn
+
+from .utils import layer_at, nested_scan, stack_layers
+
+
+def _body(carry, w):
+	return jnp.tanh(carry @ w), carry.sum()
+
+
+@pytest.mark.parametrize("group_size", [1, 2, 3, 4])
+def test_nested_scan_matches_flat_scan(group_size):
+	init = jax.random.normal(jax.random.PRNGKey(0), (2, 8))
+	xs = jax.random.normal(jax.random.PRNGKey(1), (4, 8, 8))
+
+	def loss(scan, xs):
+		carry, ys = scan(xs)
+		return carry.sum() + ys.sum()
+
+	flat = lambda xs: jax.lax.scan(_body, init, xs)  # noqa: E731
+	nested = lambda xs: nested_scan(_body, init, xs, group_size)  # noqa: E731
+	np.testing.assert_allclose(loss(nested, xs), loss(flat, xs), rtol=1e-6)
+	np.testing.assert_allclose(
+		jax.grad(lambda xs: loss(nested, xs))(xs),
+		jax.grad(lambda xs: loss(flat, xs))(xs),
+		rtol=1e-5,
+		atol=1e-6,
+	)
+
+
+def test_stack_layers_keeps_params_stacked():
+	layers = stack_layers(lambda rngs: nn.Linear(4, 3, rngs=rngs), 5, nn.Rngs(0))
+	assert layers.kernel.value.shape == (5, 4, 3)
+	x = jnp.ones((2, 4))
+	np.testing.assert_allclose(
+		layer_at(layers, 3)(x),
+		x @ layers.kernel.value[3] + layers.bias.value[3],
+		rtol=1e-6,
+	)
+	# layers are initialized with distinct rngs.
+	assert not np.allclose(layers.kernel.value[0], layers.kernel.value[1])
@@ -16,5 +16,6 @@
 # with a few bug fixes and adjustments.
 from .pallas_gemm import pallas_gemm
 from .pallas_ring_attention import pallas_ring_attention_tpu
+from .pallas_rms_norm_matmul import pallas_rms_norm_matmul
 
-__all__ = "pallas_gemm", "pallas_ring_attention_tpu"
+__all__ = "pallas_gemm", "pallas_ring_attention_tpu", "pallas_rms_norm_matmul"
@@ -0,0 +1,119 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from functools import partial
+
+import jax
+import jax.extend
+from jax import lax
+from jax import numpy as jnp
+from jax.experimental import pallas as pl
+
+PLATFORM = jax.extend.backend.get_backend().platform
+INTERPRET = PLATFORM == "cpu"
+
+
+def _rms_norm_matmul_reference(x, norm_weight, kernel, eps, precision):
+	x_f = x.astype(jnp.float32)
+	inv_rms = lax.rsqrt(jnp.square(x_f).mean(-1, keepdims=True) + eps)
+	normed = (x_f * inv_rms * norm_weight.astype(jnp.float32)).astype(kernel.dtype)
+	return jnp.dot(
+		normed,
+		kernel,
+		precision=precision,
+		preferred_element_type=jnp.float32,
+	).astype(kernel.dtype)
+
+
+def _rms_norm_matmul_kernel(x_ref, w_ref, k_ref, o_ref, *, eps, precision):
+	# every block holds whole rows of `x`, so the row statistics never leave VMEM.
+	x = x_ref[...].astype(jnp.float32)
+	inv_rms = lax.rsqrt(jnp.mean(jnp.square(x), axis=-1, keepdims=True) + eps)
+	normed = (x * inv_rms * w_ref[...].astype(jnp.float32)).astype(k_ref.dtype)
+	o_ref[...] = jnp.dot(
+		normed,
+		k_ref[...],
+		precision=precision,
+		preferred_element_type=jnp.float32,
+	).astype(o_ref.dtype)
+
+
+def _get_block_sizes(m: int, n: int):
+	blocksize_m = min(128, -(-m // 8) * 8)
+	blocksize_n = next((size for size in (512, 256, 128) if n % size == 0), n)
+	return blocksize_m, blocksize_n
+
+
+@partial(jax.jit, static_argnames=["eps", "precision"])
+def _call_rms_norm_matmul_fwd(x, norm_weight, kernel, eps, precision=None):
+	m, k = x.shape
+	n = kernel.shape[1]
+	blocksize_m, blocksize_n = _get_block_sizes(m, n)
+	padded_m = pl.cdiv(m, blocksize_m) * blocksize_m
+	if padded_m != m:
+		# zero rows normalize to zeros, and are sliced away below.
+		x = jnp.pad(x, ((0, padded_m - m), (0, 0)))
+	out = pl.pallas_call(
+		partial(_rms_norm_matmul_kernel, eps=eps, precision=precision),
+		out_shape=jax.ShapeDtypeStruct((padded_m, n), kernel.dtype),
+		grid=(padded_m // blocksize_m, n // blocksize_n),
+		in_specs=[
+			pl.BlockSpec((blocksize_m, k), lambda mi, ni: (mi, 0)),
+			pl.BlockSpec((1, k), lambda mi, ni: (0, 0)),
+			pl.BlockSpec((k, blocksize_n), lambda mi, ni: (0, ni)),
+		],
+		out_specs=pl.BlockSpec((blocksize_m, blocksize_n), lambda mi, ni: (mi, ni)),
+		compiler_params=dict(mosaic=dict(dimension_semantics=("parallel", "parallel"))),
+		interpret=INTERPRET,
+		name="tpu_rms_norm_matmul_fwd",
+	)(x, norm_weight.reshape(1, k), kernel)
+	return out[:m]
+
+
+def _call_rms_norm_matmul_fwd_residual(x, norm_weight, kernel, eps, precision):
+	out = _call_rms_norm_matmul_fwd(x, norm_weight, kernel, eps, precision)
+	return out, (x, norm_weight, kernel)
+
+
+def _call_rms_norm_matmul_bwd(eps, precision, res, gO):
+	# the backward recomputes the normalized rows instead of keeping them around.
+	_, vjp = jax.vjp(
+		partial(_rms_norm_matmul_reference, eps=eps, precision=precision),
+		*res,
+	)
+	return vjp(gO)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(3, 4))
+def pallas_rms_norm_matmul(
+	x: jax.Array,
+	norm_weight: jax.Array,
+	kernel: jax.Array,
+	eps: float,
+	precision: lax.PrecisionLike = None,
+):
+	"""
+	Computes `rms_norm(x, norm_weight) @ kernel` for a 2-D `x` in one kernel; each
+	block normalizes its rows in VMEM right before the matmul, so the normalized
+	hidden states are never written back to HBM.
+	"""
+	return _call_rms_norm_matmul_fwd(x, norm_weight, kernel, eps, precision)
+
+
+pallas_rms_norm_matmul.defvjp(
+	_call_rms_norm_matmul_fwd_residual,
+	_call_rms_norm_matmul_bwd,
+)
+
+__all__ = ["pallas_rms_norm_matmul"]
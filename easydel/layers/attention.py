@@ -57,6 +57,7 @@ from easydel.kernels.flash_attention_2 import create_flash_attention
 from easydel.kernels.ring_attention import ring_attention
 from easydel.layers._blockwise_attention import blockwise_attn
 from easydel.layers.caching import TransformerCacheView
+from easydel.layers.quantization.linear_fp8 import ArrayFP8
 from easydel.layers.quantization.quantizers import EasyQuantizer
 from easydel.utils.helpers import get_logger
 
@@ -1331,6 +1332,9 @@ class FlexibleAttentionModule(nn.Module):
 
 	@staticmethod
 	def repeat_kv_heads(key, value, num_reps: int):
+		if num_reps == 1:
+			# multi-head attention, nothing to expand; decided at trace time.
+			return key, value
 		return (
 			einops.repeat(key, "b s h d -> b s (h r) d", r=num_reps),
 			einops.repeat(value, "b s h d -> b s (h r) d", r=num_reps),
@@ -1781,6 +1785,32 @@ class FlaxAttentionModule(nn.Module):
 			attention_mask = jnp.logical_and(attention_mask, causal_mask)
 
 		slice_indices = (0, end_index % cache_view.value.shape[1], 0, 0)
+		pad_mask = jnp.broadcast_to(
+			jnp.arange(max_length) < end_index + num_updated_cache_vectors,
+			tuple(batch_dims) + (1, num_updated_cache_vectors, max_length),
+		)
+		if isinstance(cache_view.key, ArrayFP8):
+
+			def update_fp8_cache(cache: ArrayFP8, update: Array) -> ArrayFP8:
+				# only the written slice is quantized; the prompt sets the scales.
+				cache = cache.update_slice(update, slice_indices, end_index == 0)
+				weight = with_sharding_constraint(
+					arr=cache.weight,
+					sharding=self.get_sharding_safely(cache.weight),
+				)
+				return jax.tree_util.tree_unflatten(
+					jax.tree_util.tree_structure(cache),
+					(weight, cache.scale),
+				)
+
+			cache_view.key = update_fp8_cache(cache_view.key, key)
+			cache_view.value = update_fp8_cache(cache_view.value, value)
+			cache_view.index = cache_view.index + num_updated_cache_vectors
+			return (
+				cache_view.key.materialize().astype(key.dtype),
+				cache_view.value.materialize().astype(value.dtype),
+				jnp.logical_and(pad_mask, attention_mask),
+			)
 		value_cache = cache_view.value
 		key_cache = cache_view.key
 		org_cache_dtype = key_cache.dtype
@@ -1794,10 +1824,6 @@ class FlaxAttentionModule(nn.Module):
 			key,
 			slice_indices,
 		)
-		pad_mask = jnp.broadcast_to(
-			jnp.arange(max_length) < end_index + num_updated_cache_vectors,
-			tuple(batch_dims) + (1, num_updated_cache_vectors, max_length),
-		)
 		attention_mask = jnp.logical_and(pad_mask, attention_mask)
 		cache_view.key = self.quantizer(
 			with_sharding_constraint(
@@ -1909,6 +1935,8 @@ class FlaxAttentionModule(nn.Module):
 
 	@staticmethod
 	def repeat_key_value(key, value, num_reps: int):
+		if num_reps == 1:
+			return key, value
 		key = einops.repeat(
 			key,
 			"b s h d -> b s (h r) d",
@@ -19,6 +19,8 @@ from flax import nnx as nn
 from jax import lax
 from jax import numpy as jnp
 
+from easydel.kernels.tpu_ops import pallas_rms_norm_matmul
+
 
 class RMSNorm(nn.Module):
 	def __init__(
@@ -62,3 +64,50 @@ class RMSNorm(nn.Module):
 		output = self._norm(x).astype(self.dtype)
 		weight = self.kernel.astype(self.dtype)
 		return weight * output
+
+
+def rms_norm_matmul(x: jnp.ndarray, norm: RMSNorm, linear: nn.Module) -> jnp.ndarray:
+	"""
+	Computes `linear(norm(x))`. On TPU a plain `nn.Linear` goes through
+	`pallas_rms_norm_matmul`, which normalizes each row block in VMEM right before
+	the matmul so the normalized hidden states never reach HBM. Other backends and
+	other linears (quantized, LoRA) run the unfused sequence.
+	"""
+	if jax.default_backend() != "tpu" or type(linear) is not nn.Linear:
+		return linear(norm(x))
+	dtype = linear.dtype or x.dtype
+	out = pallas_rms_norm_matmul(
+		x.reshape(-1, x.shape[-1]),
+		norm.kernel.value,
+		linear.kernel.value.astype(dtype),
+		norm.eps,
+		linear.precision,
+	).reshape(*x.shape[:-1], -1)
+	if linear.use_bias:
+		out = out + linear.bias.value.astype(dtype)
+	return out
+
+
+def fused_residual_layernorm(
+	residual_states: jnp.ndarray,
+	update: jnp.ndarray,
+	scale: jnp.ndarray,
+	bias: tp.Optional[jnp.ndarray] = None,
+	*,
+	epsilon: float,
+	dtype: jnp.dtype,
+) -> tp.Tuple[jnp.ndarray, jnp.ndarray]:
+	"""
+	Adds `update` to the residual stream and layer-normalizes the sum in one pass,
+	returning the new residual stream and its normalized copy (bias-free when
+	`bias` is None).
+	"""
+	residual_states = residual_states + update
+	hidden_states = residual_states.astype(jnp.promote_types(dtype, jnp.float32))
+	mean = hidden_states.mean(-1, keepdims=True)
+	hidden_states = hidden_states - mean
+	variance = jnp.square(hidden_states).mean(-1, keepdims=True)
+	hidden_states = hidden_states * lax.rsqrt(variance + epsilon) * scale
+	if bias is not None:
+		hidden_states = hidden_states + bias
+	return residual_states, hidden_states.astype(dtype)
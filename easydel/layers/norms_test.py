@@ -0,0 +1,83 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+from flax import nnx as nn
+from jax import numpy as jnp
+
+from easydel.kernels.tpu_ops import pallas_rms_norm_matmul
+from easydel.layers.norms import RMSNorm, fused_residual_layernorm, rms_norm_matmul
+
+
+def test_rms_norm_matmul_matches_unfused():
+	norm = RMSNorm(64, eps=1e-6)
+	norm.kernel.value = jax.random.uniform(jax.random.PRNGKey(0), (64,)) + 0.5
+	linear = nn.Linear(64, 32, rngs=nn.Rngs(0))
+	linear.bias.value = jax.random.normal(jax.random.PRNGKey(1), (32,))
+	x = jax.random.normal(jax.random.PRNGKey(2), (2, 8, 64))
+	np.testing.assert_allclose(
+		rms_norm_matmul(x, norm, linear),
+		linear(norm(x)),
+		rtol=1e-5,
+		atol=1e-5,
+	)
+	lora = nn.LoRALinear(64, 32, lora_rank=4, rngs=nn.Rngs(0))
+	lora.lora.lora_b.value = jax.random.normal(jax.random.PRNGKey(3), (4, 32))
+	np.testing.assert_allclose(rms_norm_matmul(x, norm, lora), lora(norm(x)), rtol=1e-6)
+
+
+def test_pallas_rms_norm_matmul_matches_unfused():
+	norm = RMSNorm(64, eps=1e-6)
+	norm.kernel.value = jax.random.uniform(jax.random.PRNGKey(0), (64,)) + 0.5
+	kernel = jax.random.normal(jax.random.PRNGKey(1), (64, 256))
+	x = jax.random.normal(jax.random.PRNGKey(2), (20, 64))
+
+	def fused(x, weight, kernel):
+		return pallas_rms_norm_matmul(x, weight, kernel, norm.eps).sum()
+
+	def unfused(x, weight, kernel):
+		normed = x * jax.lax.rsqrt(jnp.square(x).mean(-1, keepdims=True) + norm.eps)
+		return ((normed * weight) @ kernel).sum()
+
+	args = (x, norm.kernel.value, kernel)
+	np.testing.assert_allclose(
+		pallas_rms_norm_matmul(*args, norm.eps),
+		norm(x) @ kernel,
+		rtol=1e-5,
+		atol=1e-4,
+	)
+	for got, expected in zip(
+		jax.grad(fused, argnums=(0, 1, 2))(*args),
+		jax.grad(unfused, argnums=(0, 1, 2))(*args),
+	):
+		np.testing.assert_allclose(got, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_fused_residual_layernorm_matches_unfused():
+	norm = nn.LayerNorm(64, rngs=nn.Rngs(0))
+	norm.scale.value = jax.random.uniform(jax.random.PRNGKey(0), (64,)) + 0.5
+	norm.bias.value = jax.random.normal(jax.random.PRNGKey(1), (64,))
+	residual = jax.random.normal(jax.random.PRNGKey(2), (2, 8, 64))
+	update = jax.random.normal(jax.random.PRNGKey(3), (2, 8, 64))
+	out, normed = fused_residual_layernorm(
+		residual,
+		update,
+		norm.scale.value,
+		norm.bias.value,
+		epsilon=norm.epsilon,
+		dtype=residual.dtype,
+	)
+	np.testing.assert_allclose(out, residual + update, rtol=1e-6)
+	np.testing.assert_allclose(normed, norm(residual + update), rtol=1e-5, atol=1e-5)
@@ -11,8 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from .embed_8bit import Embed8bit
 from .linear_8bit import Linear8bit
+from .linear_fp8 import LinearFP8
 from .linear_nf4 import LinearNF4
+from .linear_ternary import LinearTernary
 from .quantizers import EasyQuantizer
 
-__all__ = "EasyQuantizer", "LinearNF4", "Linear8bit"
+__all__ = (
+	"EasyQuantizer",
+	"LinearNF4",
+	"Linear8bit",
+	"LinearFP8",
+	"LinearTernary",
+	"Embed8bit",
+)
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import partial
+import math
+import typing as tp
+from functools import lru_cache, partial
 
 import jax
+import numpy as np
+from jax import lax
 from jax import numpy as jnp
 
 NF4_TABLE = jnp.array(
@@ -62,33 +66,186 @@ NF4_BOUNDARIES = jnp.array(
 )
 
 
+_NF4_QUANTIZE_CHUNK_BLOCKS = 65536
+# nibble offsets of the 8 planes packed into every uint32 word, first plane on top.
+_NF4_SHIFTS = np.arange(28, -1, -4, dtype=np.uint32)
+_NF4_ABSMAX_GROUP_SIZE = 256
+_NF4_DEQUANTIZE_CHUNK_ELEMENTS = 1 << 22
+
+
+@lru_cache
+def _nf4_table(dtype: jnp.dtype) -> np.ndarray:
+	"""Returns the NF4 levels cast to `dtype`, so the dequant gather runs natively in it."""
+	return np.asarray(NF4_TABLE, dtype=dtype)
+
+
+def _nearest_nf4_code(normalized):
+	"""Branchless nearest-code lookup against the 16 NF4 levels."""
+	distance = jnp.abs(normalized[..., None] - NF4_TABLE)
+	return jnp.argmin(distance, axis=-1).astype(jnp.uint32)
+
+
+def _blockwise_absmax(flat, block_size):
+	"""
+	Per-block absolute maximum, reduced straight over the flat buffer as
+	`max(max(x), -min(x))` so no `abs(x)` temporary is materialized.
+	"""
+	window = dict(
+		window_dimensions=(block_size,),
+		window_strides=(block_size,),
+		padding="VALID",
+	)
+	maximum = lax.reduce_window(flat, -jnp.inf, lax.max, **window)
+	minimum = lax.reduce_window(flat, jnp.inf, lax.min, **window)
+	return jnp.maximum(maximum, -minimum)
+
+
+def _pad_to_blocks(flat, block_size):
+	"""
+	Zero-pads a flat buffer up to a whole number of blocks, the padded tail
+	quantizes to exact zeros and is trimmed again by the dequantization callers.
+	"""
+	padding = (-flat.shape[0]) % block_size
+	if padding == 0:
+		return flat
+	return lax.pad(flat, jnp.zeros((), flat.dtype), [(0, padding, 0)])
+
+
+def _keep_leading_shape(shape, block_size, packed, absmax):
+	"""
+	Reshapes the flat `packed`/`absmax` of an input of `shape` so leading dimensions
+	beyond the last two are kept. The flat pass only lines up with the leading
+	slices when none of their blocks straddles two slices.
+	"""
+	if len(shape) > 2 and math.prod(shape[-2:]) % block_size == 0:
+		leading_shape = shape[:-2]
+		packed = packed.reshape(*leading_shape, -1)
+		absmax = absmax.reshape(*leading_shape, -1)
+	return packed, absmax
+
+
+def _pack_nf4_blocks(blocks, absmax, block_size):
+	"""Normalizes `blocks` by `absmax`, picks the NF4 codes and packs them."""
+	normalized = blocks / absmax[:, None]
+	quantized = lax.map(
+		_nearest_nf4_code,
+		normalized,
+		batch_size=_NF4_QUANTIZE_CHUNK_BLOCKS,
+	)
+	planes = quantized.reshape(-1, 8, block_size // 8)
+	packed = jnp.sum(planes << _NF4_SHIFTS[:, None], axis=1, dtype=jnp.uint32)
+	return packed.reshape(-1)
+
+
 @partial(jax.jit, static_argnames=["block_size"])
 def single_quantize_and_pack_nf4(blocks, block_size=64):
 	"""
 	Combined quantization and packing for better performance.
 	Handles normalization, quantization, and packing in a single operation.
+
+	Each block is split into 8 planes of `block_size // 8` codes and packed
+	into uint32 words, word `j` holding the `j`-th code of every plane (SWAR),
+	so the whole block unpacks with a single shift-and-mask pass. Inputs whose
+	size is not a multiple of `block_size` are zero-padded to the next block.
 	"""
-	blocks = blocks.reshape(-1, block_size)
-	absmax = jnp.max(jnp.abs(blocks), axis=1)
-	normalized = blocks / absmax[:, None]
-	quantized = jnp.searchsorted(NF4_BOUNDARIES, normalized.reshape(-1)) - 1
-	quantized = quantized.reshape(-1, 2)
-	packed = (quantized[:, 0] << 4) | quantized[:, 1]
-	return packed.astype(jnp.uint8), absmax
+	flat = _pad_to_blocks(blocks.reshape(-1), block_size)
+	absmax = _blockwise_absmax(flat, block_size)
+	blocks = flat.reshape(-1, block_size)
+	return _pack_nf4_blocks(blocks, absmax, block_size), absmax
+
+
+def quantize_and_pack_nf4_numpy(blocks: np.ndarray, block_size: int = 64):
+	"""
+	NumPy twin of `quantize_and_pack_nf4` for one-shot quantization of
+	host-resident weights at load time, where tracing and compiling an XLA
+	program per layer costs more than the quantization itself.
+	Produces exactly the same packed words and scales as the JAX version.
+	"""
+	shape = np.shape(blocks)
+	blocks = np.asarray(blocks).reshape(-1)
+	blocks = np.pad(blocks, (0, (-blocks.size) % block_size)).reshape(-1, block_size)
+	absmax = np.maximum(blocks.max(axis=1), -blocks.min(axis=1))
+	table = np.asarray(NF4_TABLE)
+	packed = np.empty((blocks.shape[0], block_size // 8), dtype=np.uint32)
+	for start in range(0, blocks.shape[0], _NF4_QUANTIZE_CHUNK_BLOCKS):
+		chunk = slice(start, start + _NF4_QUANTIZE_CHUNK_BLOCKS)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			normalized = blocks[chunk] / absmax[chunk, None]
+		distance = np.abs(normalized[..., None].astype(np.float32) - table)
+		codes = np.argmin(distance, axis=-1).astype(np.uint32)
+		planes = codes.reshape(-1, 8, block_size // 8)
+		packed[chunk] = np.bitwise_or.reduce(planes << _NF4_SHIFTS[:, None], axis=1)
+	return _keep_leading_shape(shape, block_size, packed.reshape(-1), absmax)
+
+
+@jax.jit
+def quantize_absmax(absmax: jax.Array):
+	"""
+	Second-level 8-bit quantization of the NF4 block scales (double quantization).
+	Scales are grouped by 256 and stored as uint8 against one float32 scale per
+	group, rounding up so a non-zero block never ends up with a zero scale. The
+	last group is zero-padded when the scale count is not a multiple of 256.
+	"""
+	flat = absmax.reshape(-1).astype(jnp.float32)
+	flat = jnp.pad(flat, (0, (-flat.size) % _NF4_ABSMAX_GROUP_SIZE))
+	groups = flat.reshape(-1, _NF4_ABSMAX_GROUP_SIZE)
+	absmax_scale = jnp.max(groups, axis=1) / 255.0
+	absmax_scale = jnp.where(absmax_scale == 0, 1.0, absmax_scale)
+	absmax_q = jnp.clip(jnp.ceil(groups / absmax_scale[:, None]), 0, 255)
+	absmax_q = absmax_q.astype(jnp.uint8).reshape(-1)[: absmax.size]
+	return absmax_q.reshape(absmax.shape), absmax_scale
+
+
+@partial(jax.jit, static_argnames=["dtype"])
+def dequantize_absmax(absmax_q: jax.Array, absmax_scale: jax.Array, dtype: jnp.dtype):
+	"""Recovers the NF4 block scales stored by `quantize_absmax`."""
+	flat = absmax_q.reshape(-1).astype(jnp.float32)
+	flat = jnp.pad(flat, (0, (-flat.size) % _NF4_ABSMAX_GROUP_SIZE))
+	groups = flat.reshape(absmax_scale.shape[0], _NF4_ABSMAX_GROUP_SIZE)
+	absmax = (groups * absmax_scale[:, None]).reshape(-1)[: absmax_q.size]
+	return absmax.reshape(absmax_q.shape).astype(dtype)
 
 
 @partial(jax.jit, static_argnames=["block_size"])
-def single_dequantize_nf4(packed_values, absmax, block_size):
+def double_quantize_and_pack_nf4(blocks: jax.Array, block_size: int = 64):
+	"""
+	Same as `single_quantize_and_pack_nf4`, but also quantizes the block scales
+	with `quantize_absmax`. Blocks are normalized by the recovered scales so the
+	codes agree with what `dequantize_absmax` gives back.
+	"""
+	flat = _pad_to_blocks(blocks.reshape(-1), block_size)
+	absmax = _blockwise_absmax(flat, block_size)
+	blocks = flat.reshape(-1, block_size)
+	absmax_q, absmax_scale = quantize_absmax(absmax)
+	absmax = dequantize_absmax(absmax_q, absmax_scale, blocks.dtype)
+	return _pack_nf4_blocks(blocks, absmax, block_size), absmax_q, absmax_scale
+
+
+def _restore_shape(dequantized, out_shape):
+	"""Trims the zero padding of the last block and reshapes to `out_shape`."""
+	if out_shape is None:
+		return dequantized
+	num_elements = math.prod(out_shape)
+	if dequantized.size != num_elements:
+		dequantized = dequantized.reshape(-1)[:num_elements]
+	return dequantized.reshape(out_shape)
+
+
+@partial(jax.jit, static_argnames=["block_size", "out_shape"])
+def single_dequantize_nf4(packed_values, absmax, block_size, out_shape=None):
 	"""
 	Optimized dequantization combining unpacking and scaling in fewer operations.
+	Returns an array of shape `(*absmax.shape, block_size)`, or `out_shape` when
+	given (padding of the last block is trimmed away first).
 	"""
-	high = (packed_values >> 4) & 0xF
-	low = packed_values & 0xF
-	unpacked = jnp.stack([high, low], axis=1).reshape(-1)
-	dequantized = NF4_TABLE[unpacked]
-	dequantized = dequantized.reshape(len(absmax), block_size)
-	scaled = dequantized * absmax[:, None]
-	return scaled
+	table = jnp.asarray(_nf4_table(absmax.dtype))
+	packed_values = packed_values.reshape(*absmax.shape, 1, block_size // 8)
+	unpacked = (packed_values >> _NF4_SHIFTS[:, None]) & 0xF
+	# Nibbles are in [0, 15] by construction, so the gather can skip its bounds clamp.
+	dequantized = table.at[unpacked].get(mode="promise_in_bounds")
+	dequantized = dequantized.reshape(*absmax.shape, block_size)
+	scaled = dequantized * absmax[..., None]
+	return _restore_shape(scaled, out_shape)
 
 
 @partial(jax.jit, static_argnames=["block_size"])
@@ -96,24 +253,167 @@ def quantize_and_pack_nf4(
 	blocks: jax.Array,
 	block_size: int = 64,
 ):
-	if blocks.ndim > 2:
-		return jax.vmap(
-			quantize_and_pack_nf4,
-			in_axes=(0, None),
-			out_axes=(0, 0),
-		)(blocks, block_size)
-	return single_quantize_and_pack_nf4(blocks, block_size)
+	"""
+	Quantizes `blocks` to packed NF4. Leading dimensions beyond the last two are
+	kept on the outputs, while everything is quantized in a single flat pass.
+	"""
+	packed, absmax = single_quantize_and_pack_nf4(blocks, block_size)
+	return _keep_leading_shape(blocks.shape, block_size, packed, absmax)
 
 
-@partial(jax.jit, static_argnames=["block_size"])
+@partial(jax.jit, static_argnames=["block_size", "out_shape"])
 def dequantize_nf4(
 	packed_values: jax.Array,
 	absmax: jax.Array,
 	block_size: int,
+	out_shape: tp.Optional[tp.Tuple[int, ...]] = None,
+):
+	"""
+	Dequantizes packed NF4 values, leading dimensions of `absmax` are kept on
+	the output so sharded layouts are never flattened, unless `out_shape` asks
+	for a specific shape.
+
+	The leading axis is walked in chunks of about `_NF4_DEQUANTIZE_CHUNK_ELEMENTS`
+	weights (`lax.map` runs any remainder rows as a final smaller chunk), each
+	chunk unpacking, gathering and scaling its own slice, so the integer codes and
+	gathered levels never exist for the whole kernel at once.
+	"""
+	packed_values = packed_values.reshape(*absmax.shape, block_size // 8)
+	num_rows = absmax.shape[0] if absmax.ndim else 1
+	row_elements = math.prod(absmax.shape[1:]) * block_size
+	chunk_rows = max(min(_NF4_DEQUANTIZE_CHUNK_ELEMENTS // row_elements, num_rows), 1)
+	if chunk_rows == num_rows:
+		return single_dequantize_nf4(packed_values, absmax, block_size, out_shape)
+	dequantized = lax.map(
+		lambda operands: single_dequantize_nf4(*operands, block_size),
+		(packed_values, absmax),
+		batch_size=chunk_rows,
+	)
+	return _restore_shape(dequantized, out_shape)
+
+
+@partial(jax.jit, static_argnames=["block_size", "out_shape"])
+def dequantize_nf4_stacked(
+	packed_values: jax.Array,
+	absmax: jax.Array,
+	block_size: int,
+	out_shape: tp.Optional[tp.Tuple[int, ...]] = None,
+):
+	"""
+	Dequantizes a stack of same-shaped NF4 kernels (one per layer along the leading
+	axis) in a single program, `lax.map` walks the layers one at a time.
+	"""
+	return lax.map(
+		lambda operands: dequantize_nf4(*operands, block_size, out_shape),
+		(packed_values, absmax),
+	)
+
+
+# a few MiB per dequantized tile, so typical projections (e.g. 4096 x 4096 in bf16)
+# are walked in several tiles instead of being materialized whole.
+_NF4_MATMUL_TILE_BYTES = 1 << 22
+_NF4_MATMUL_TILE_ALIGNMENTS = (128, 64, 32, 8, 1)
+
+
+@lru_cache
+def _get_tile_size(
+	in_features: int,
+	out_features: int,
+	block_size: int,
+	itemsize: int,
+) -> int:
+	"""
+	Picks how many kernel rows get dequantized per step of `dequantize_nf4_matmul`
+	for one layer shape and compute dtype, the result is cached per shape.
+
+	The tile has to cover whole quantization blocks, evenly divide `in_features`
+	and fit `_NF4_MATMUL_TILE_BYTES` once dequantized. Among those the largest
+	tile aligned to the biggest possible power of two (128 first) wins, which
+	keeps every per-tile matmul on MXU/tensor-core friendly shapes.
+	"""
+	max_rows = max(_NF4_MATMUL_TILE_BYTES // (out_features * itemsize), 1)
+	max_rows = min(max_rows, in_features)
+	for alignment in _NF4_MATMUL_TILE_ALIGNMENTS:
+		for tile_size in range(max_rows - max_rows % alignment, 0, -alignment):
+			if in_features % tile_size == 0 and (tile_size * out_features) % block_size == 0:
+				return tile_size
+	return in_features
+
+
+@partial(
+	jax.jit,
+	static_argnames=["out_features", "block_size", "dtype", "precision"],
+)
+def dequantize_nf4_matmul(
+	inputs: jax.Array,
+	packed_values: jax.Array,
+	absmax: jax.Array,
+	out_features: int,
+	block_size: int,
+	dtype: tp.Optional[jnp.dtype] = None,
+	precision: lax.PrecisionLike = None,
 ):
-	packed_values = packed_values.astype(jnp.uint8)
-	if packed_values.ndim > 2:
-		return jax.vmap(dequantize_nf4, in_axes=(0, 0, None), out_axes=(0,))(
-			packed_values, absmax, block_size
+	"""
+	Computes `inputs @ dequantize_nf4(packed_values, absmax)` without ever
+	materializing the full `(in_features, out_features)` kernel.
+
+	The packed kernel is walked in row tiles; each step dequantizes one tile
+	and accumulates its contribution, so the peak temporary is a single
+	tile instead of the whole kernel. Kernel-shaped packs (2-D `absmax` of
+	shape `(in_features, out_features // block_size)`) are sliced along rows
+	only, which keeps any sharding of the output axis intact.
+
+	Products and the running sum over tiles are accumulated in float32 no
+	matter the compute dtype, the NF4 rounding error already eats the low bits
+	of the weights and a bf16 accumulator would compound on top of it.
+	"""
+	in_features = inputs.shape[-1]
+	if dtype is None:
+		dtype = jnp.result_type(inputs, absmax)
+	inputs = inputs.astype(dtype)
+	tile_size = _get_tile_size(
+		in_features,
+		out_features,
+		block_size,
+		jnp.dtype(dtype).itemsize,
+	)
+	num_tiles = in_features // tile_size
+	dimension_numbers = (((inputs.ndim - 1,), (0,)), ((), ()))
+	if absmax.ndim == 2:
+
+		def _tile_operands(idx):
+			return (
+				lax.dynamic_slice_in_dim(packed_values, idx * tile_size, tile_size, axis=0),
+				lax.dynamic_slice_in_dim(absmax, idx * tile_size, tile_size, axis=0),
+			)
+	else:
+		packed_tiles = packed_values.reshape(num_tiles, -1)
+		absmax_tiles = absmax.reshape(num_tiles, -1)
+
+		def _tile_operands(idx):
+			return packed_tiles[idx], absmax_tiles[idx]
+
+	def _tile_matmul(idx):
+		kernel = single_dequantize_nf4(
+			*_tile_operands(idx),
+			block_size,
+			(tile_size, out_features),
+		).astype(dtype)
+		tile = lax.dynamic_slice_in_dim(inputs, idx * tile_size, tile_size, axis=-1)
+		return lax.dot_general(
+			tile,
+			kernel,
+			dimension_numbers,
+			precision=precision,
+			preferred_element_type=jnp.float32,
 		)
-	return single_dequantize_nf4(packed_values, absmax, block_size)
+
+	if num_tiles == 1:
+		return _tile_matmul(0).astype(dtype)
+
+	return lax.fori_loop(
+		0,
+		num_tiles,
+		lambda idx, acc: acc + _tile_matmul(idx),
+		jnp.zeros((*inputs.shape[:-1], out_features), dtype=jnp.float32),
+	).astype(dtype)
@@ -0,0 +1,103 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import typing as tp
+
+import jax
+import jax.numpy as jnp
+from flax import nnx
+from flax.typing import Dtype
+from jax import lax
+
+from .base_quant import QauntModule
+from .linear_8bit import dequantize_8bit, quantize_8bit
+
+Array = jax.Array
+
+
+class Embed8bit(QauntModule):
+	"""An int8 weight-only embedding table with one scale per vocabulary row."""
+
+	def __init__(
+		self,
+		num_embeddings: int,
+		features: int,
+		*,
+		dtype: tp.Optional[Dtype] = None,
+		param_dtype: Dtype = jnp.float32,
+	):
+		super().__init__(dtype=dtype, param_dtype=param_dtype)
+		self.quant_embedding = nnx.Param(None)
+		self.quant_scales = nnx.Param(None)
+		self.num_embeddings = num_embeddings
+		self.features = features
+
+	@classmethod
+	def from_embed(cls, embed: nnx.Embed, **kwargs) -> "Embed8bit":
+		"""
+		Create an Embed8bit module from a regular Embed module.
+
+		Args:
+				embed: The source Embed module
+
+		Returns:
+				A new Embed8bit module with int8 rows and per-row scales
+		"""
+		instance = cls(
+			num_embeddings=embed.num_embeddings,
+			features=embed.features,
+			dtype=embed.dtype,
+			param_dtype=embed.param_dtype,
+		)
+		quant_embedding, quant_scales = quantize_8bit(embed.embedding.value)
+		instance.quant_embedding = nnx.Param(quant_embedding)
+		instance.quant_scales = nnx.Param(quant_scales)
+		return instance
+
+	@jax.named_scope("easydel-embed-8bit-call")
+	def __call__(self, inputs: Array) -> Array:
+		"""Gathers the int8 rows and their scales, dequantizing only those rows."""
+		dtype = self.dtype or self.param_dtype
+		rows = jnp.take(self.quant_embedding.value, inputs, axis=0)
+		scales = jnp.take(self.quant_scales.value, inputs, axis=0)
+		return dequantize_8bit(rows.astype(dtype), scales.astype(dtype))
+
+	def attend(self, query: Array) -> Array:
+		"""Logits against the int8 table, used for tied output projections."""
+		dtype = self.dtype or query.dtype
+		# contracting on the feature axis of both operands needs no transpose, and
+		# the per-row scales land on the vocab axis of the output.
+		logits = lax.dot_general(
+			query.astype(dtype),
+			self.quant_embedding.value.astype(dtype),
+			(((query.ndim - 1,), (1,)), ((), ())),
+			preferred_element_type=jnp.float32,
+		)
+		return logits * self.quant_scales.value[:, 0].astype(jnp.float32)
+
+	def get_embedding(self):
+		"""Get the dequantized embedding table."""
+		return dequantize_8bit(
+			self.quant_embedding.value.astype(self.param_dtype),
+			self.quant_scales.value.astype(self.param_dtype),
+		)
+
+	@staticmethod
+	def metadata():
+		return {"quant_mode": "8bit"}
+
+	@staticmethod
+	def quantization_mapping():
+		return {"embedding": ["quant_embedding", "quant_scales"]}
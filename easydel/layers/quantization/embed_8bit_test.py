@@ -0,0 +1,38 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+from flax import nnx
+from jax import numpy as jnp
+
+from .embed_8bit import Embed8bit
+
+
+def test_embed_8bit_lookup_and_attend():
+	embed = nnx.Embed(512, 64, rngs=nnx.Rngs(0))
+	quantized = Embed8bit.from_embed(embed)
+	assert quantized.quant_embedding.value.dtype == jnp.int8
+	ids = jnp.array([[0, 7, 511]])
+	np.testing.assert_allclose(
+		quantized(ids), quantized.get_embedding()[ids], rtol=1e-6, atol=1e-6
+	)
+	np.testing.assert_allclose(quantized(ids), embed(ids), atol=2e-2)
+	query = jax.random.normal(jax.random.PRNGKey(1), (2, 3, 64))
+	np.testing.assert_allclose(
+		quantized.attend(query),
+		query @ quantized.get_embedding().T,
+		rtol=1e-4,
+		atol=1e-4,
+	)
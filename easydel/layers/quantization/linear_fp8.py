@@ -0,0 +1,242 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import typing as tp
+
+import jax
+import jax.numpy as jnp
+from eformer.jaximus import ArrayValue
+from eformer.jaximus._core import field
+from flax import nnx
+from flax.nnx import rnglib
+from flax.nnx.nn import initializers
+from flax.typing import (
+	DotGeneralT,
+	Dtype,
+	Initializer,
+	PrecisionLike,
+)
+from jax import lax
+
+from .base_quant import QauntModule
+
+Array = jax.Array
+
+default_kernel_init = initializers.lecun_normal()
+default_bias_init = initializers.zeros_init()
+
+FP8_DTYPE = jnp.float8_e4m3fn
+FP8_MAX = float(jnp.finfo(FP8_DTYPE).max)
+
+
+def quantize_fp8(x):
+	"""
+	Quantize a `(in_features, out_features)` kernel to float8 e4m3 with one scale
+	per output channel.
+	"""
+	max_val = jnp.amax(jnp.abs(x.astype(jnp.float32)), axis=0, keepdims=True)
+	qscale = jnp.clip(max_val, min=1e-5) / FP8_MAX
+	qweight = jnp.clip(x / qscale, -FP8_MAX, FP8_MAX).astype(FP8_DTYPE)
+	return qweight, qscale.astype(jnp.bfloat16)
+
+
+def dequantize_fp8(quants, scales, dtype=jnp.float32):
+	"""Dequantize float8 values back to `dtype` using per-channel scales."""
+	return quants.astype(dtype) * scales.astype(dtype)
+
+
+class ArrayFP8(ArrayValue):
+	"""
+	Float8 (e4m3) implicit array with one scale per (leading index, second-to-last
+	index), which for a `(batch, seq, heads, dim)` KV cache is one scale per
+	(batch, head).
+	"""
+
+	weight: Array
+	scale: Array
+	_adtype: jnp.dtype = field(static=True)
+
+	def __init__(self, array: Array, scale: tp.Optional[Array] = None):
+		self._adtype = array.dtype
+		if scale is None:
+			scale = _fp8_scale(array)
+		self.weight = jnp.clip(array / scale, -FP8_MAX, FP8_MAX).astype(FP8_DTYPE)
+		self.scale = scale.astype(jnp.bfloat16)
+
+	def update_slice(
+		self,
+		update: Array,
+		start_indices: tp.Sequence[int],
+		reset_scale: tp.Union[bool, Array] = False,
+	) -> "ArrayFP8":
+		"""
+		Writes `update` at `start_indices`, quantizing only the written slice.
+
+		With `reset_scale` (the first write into a cache) the scales are taken from
+		`update`; otherwise the existing ones are kept, so the stored values stay
+		valid and later writes saturate beyond their range.
+		"""
+		scale = jnp.where(reset_scale, _fp8_scale(update), self.scale)
+		written = ArrayFP8(update.astype(self._adtype), scale=scale)
+		weight = lax.dynamic_update_slice(self.weight, written.weight, start_indices)
+		return jax.tree_util.tree_unflatten(
+			jax.tree_util.tree_structure(self),
+			(weight, written.scale),
+		)
+
+	def materialize(self):
+		return dequantize_fp8(self.weight, self.scale).astype(self._adtype)
+
+
+def _fp8_scale(array: Array) -> Array:
+	"""Per (leading, second-to-last) index `ArrayFP8` scales of `array`."""
+	axes = tuple(axis for axis in range(1, array.ndim) if axis != array.ndim - 2)
+	max_val = jnp.amax(jnp.abs(array.astype(jnp.float32)), axis=axes, keepdims=True)
+	return (jnp.clip(max_val, min=1e-5) / FP8_MAX).astype(jnp.bfloat16)
+
+
+class LinearFP8(QauntModule):
+	"""Linear layer with a float8 (e4m3) kernel and per-output-channel scales."""
+
+	def __init__(
+		self,
+		in_features: int,
+		out_features: int,
+		*,
+		use_bias: bool = True,
+		dtype: tp.Optional[Dtype] = None,
+		param_dtype: Dtype = jnp.float32,
+		precision: PrecisionLike = None,
+		do_init: bool = False,
+		kernel_init: Initializer = default_kernel_init,
+		bias_init: Initializer = default_bias_init,
+		dot_general: DotGeneralT = lax.dot_general,
+		rngs: rnglib.Rngs,
+	):
+		super().__init__(
+			dtype=dtype,
+			param_dtype=param_dtype,
+			precision=precision,
+		)
+		if do_init:
+			kernel = kernel_init(rngs.params(), (in_features, out_features), param_dtype)
+			quantized_kernel, quant_scales = self._quantize_kernel(kernel)
+		else:
+			quantized_kernel, quant_scales = None, None
+
+		self.quant_kernel = nnx.Param(quantized_kernel)
+		self.quant_scales = nnx.Param(quant_scales)
+
+		if use_bias and do_init:
+			self.bias = nnx.Param(bias_init(rngs.params(), (out_features,), param_dtype))
+		else:
+			self.bias = nnx.Param(None)
+
+		self.in_features = in_features
+		self.out_features = out_features
+		self.use_bias = use_bias
+		self.kernel_init = kernel_init
+		self.bias_init = bias_init
+		self.dot_general = dot_general
+
+	@classmethod
+	def from_linear(
+		cls,
+		linear: nnx.Linear,
+		rngs: tp.Optional[rnglib.Rngs] = None,
+		**kwargs,
+	) -> "LinearFP8":
+		"""
+		Create a LinearFP8 module from a regular Linear module.
+
+		Args:
+				linear: The source Linear module
+				rngs: Random number generator state
+
+		Returns:
+				A new LinearFP8 module with float8 weights
+		"""
+		if rngs is None:
+			rngs = nnx.Rngs(0)
+		instance = nnx.eval_shape(
+			lambda: cls(
+				in_features=linear.in_features,
+				out_features=linear.out_features,
+				use_bias=linear.use_bias,
+				dtype=linear.dtype,
+				param_dtype=linear.param_dtype,
+				precision=linear.precision,
+				kernel_init=linear.kernel_init,
+				bias_init=linear.bias_init,
+				rngs=rngs,
+			)
+		)
+		quantized_kernel, quant_scales = cls._quantize_kernel(linear.kernel.value)
+		instance.quant_kernel = nnx.Param(quantized_kernel)
+		instance.quant_scales = nnx.Param(quant_scales)
+		if linear.use_bias:
+			instance.bias = nnx.Param(linear.bias.value)
+		return instance
+
+	@staticmethod
+	def _quantize_kernel(kernel):
+		"""Quantize the kernel weights."""
+		if kernel is None or isinstance(kernel, jax.ShapeDtypeStruct):
+			return None, None
+		return quantize_fp8(kernel)
+
+	def _dequantize_kernel(self):
+		"""Dequantize the kernel weights."""
+		if self.quant_kernel.value is None:
+			return None
+		return dequantize_fp8(
+			self.quant_kernel.value,
+			self.quant_scales.value,
+			self.param_dtype,
+		)
+
+	@jax.named_scope("easydel-linear-fp8-call")
+	def __call__(self, inputs: Array) -> Array:
+		"""Matmul against the float8 kernel, applying the channel scales afterwards."""
+		dtype = self.dtype or inputs.dtype
+		# the per-output-channel scale commutes with the contraction, so it is
+		# applied to the output instead of materializing a dequantized kernel.
+		out = self.dot_general(
+			inputs.astype(dtype),
+			self.quant_kernel.value.astype(dtype),
+			(((inputs.ndim - 1,), (0,)), ((), ())),
+			precision=self.precision,
+			preferred_element_type=jnp.float32,
+		)
+		out = out * self.quant_scales.value.astype(jnp.float32)
+		if self.use_bias:
+			out = out + self.bias.value
+		return out.astype(dtype)
+
+	def get_kernel(self):
+		"""Get the dequantized kernel weights."""
+		return self._dequantize_kernel()
+
+	def get_quantized_kernel(self):
+		"""Get the float8 kernel weights and their scales."""
+		return self.quant_kernel.value, self.quant_scales.value
+
+	@staticmethod
+	def metadata():
+		return {"quant_mode": "fp8"}
+
+	@staticmethod
+	def quantization_mapping():
+		return {"kernel": ["quant_kernel", "quant_scales"]}
@@ -0,0 +1,73 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+from flax import nnx
+from jax import numpy as jnp
+
+from easydel.infra.etils import EasyDeLQuantizationMethods
+from easydel.infra.mixins.bridge import _resolve_quantization_method
+from easydel.infra.utils import get_dot_general_by_bits
+
+from .linear_fp8 import ArrayFP8, LinearFP8
+
+
+def test_linear_fp8_from_linear():
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	quantized = LinearFP8.from_linear(linear)
+	assert quantized.quant_kernel.value.dtype == jnp.float8_e4m3fn
+	assert quantized.quant_scales.value.shape == (1, 256)
+	inputs = jax.random.normal(jax.random.PRNGKey(1), (2, 3, 128))
+	expected = inputs @ quantized.get_kernel() + linear.bias.value
+	np.testing.assert_allclose(quantized(inputs), expected, rtol=1e-2, atol=1e-2)
+	relative = (
+		jnp.abs(quantized.get_kernel() - linear.kernel.value).max()
+		/ jnp.abs(linear.kernel.value).max()
+	)
+	assert relative < 0.07
+
+
+def test_array_fp8_per_head_scales():
+	cache = jax.random.normal(jax.random.PRNGKey(2), (2, 16, 4, 32), dtype=jnp.bfloat16)
+	cache = cache * jnp.array([1.0, 10.0, 0.1, 100.0], jnp.bfloat16)[:, None]
+	quantized = ArrayFP8(cache)
+	assert quantized.weight.dtype == jnp.float8_e4m3fn
+	assert quantized.scale.shape == (2, 1, 4, 1)
+	restored = quantized.materialize()
+	assert restored.dtype == jnp.bfloat16
+	error = jnp.abs(restored - cache).astype(jnp.float32).max(axis=(0, 1, 3))
+	assert jnp.all(error <= jnp.abs(cache).astype(jnp.float32).max(axis=(0, 1, 3)) * 0.07)
+
+
+def test_array_fp8_update_slice():
+	cache = ArrayFP8(jnp.zeros((2, 16, 4, 32), jnp.bfloat16))
+	prompt = jax.random.normal(jax.random.PRNGKey(4), (2, 6, 4, 32), dtype=jnp.bfloat16)
+	cache = cache.update_slice(prompt, (0, 0, 0, 0), reset_scale=True)
+	step = prompt[:, :1] * 0.5
+	cache = cache.update_slice(step, (0, 6, 0, 0))
+	restored = cache.materialize()
+	expected = jnp.concatenate([prompt, step], axis=1).astype(jnp.float32)
+	error = jnp.abs(restored[:, :7].astype(jnp.float32) - expected).max()
+	assert error <= jnp.abs(expected).max() * 0.07
+	assert jnp.all(restored[:, 7:] == 0)
+
+
+def test_fp8_bits_load_as_linear_fp8():
+	linear = nnx.Linear(128, 64, **get_dot_general_by_bits("fp8"), rngs=nnx.Rngs(0))
+	quantized = LinearFP8.from_linear(linear)
+	assert quantized.dot_general is jax.lax.dot_general
+	config = type("Config", (), {"bits": "fp8"})()
+	method = _resolve_quantization_method(config, None)
+	assert method == EasyDeLQuantizationMethods.FP8
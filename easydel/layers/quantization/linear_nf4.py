@@ -14,10 +14,10 @@
 from __future__ import annotations
 
 import typing as tp
-from functools import partial
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 from flax import nnx
 from flax.nnx import rnglib
 from flax.nnx.nn import dtypes, initializers
@@ -29,6 +29,15 @@ from flax.typing import (
 )
 from jax import lax
 
+from ._nf4_quantizer import (
+	dequantize_absmax,
+	dequantize_nf4,
+	dequantize_nf4_matmul,
+	dequantize_nf4_stacked,
+	double_quantize_and_pack_nf4,
+	quantize_and_pack_nf4,
+	quantize_and_pack_nf4_numpy,
+)
 from .base_quant import QauntModule
 
 Array = jax.Array
@@ -38,109 +47,17 @@ Size = int
 
 default_kernel_init = initializers.lecun_normal()
 default_bias_init = initializers.zeros_init()
-NF4_TABLE = jnp.array(
-	[
-		-1.0,
-		-0.6961928009986877,
-		-0.5250730514526367,
-		-0.39491748809814453,
-		-0.28444138169288635,
-		-0.18477343022823334,
-		-0.09105003625154495,
-		0.0,
-		0.07958029955625534,
-		0.16093020141124725,
-		0.24611230194568634,
-		0.33791524171829224,
-		0.44070982933044434,
-		0.5626170039176941,
-		0.7229568362236023,
-		1.0,
-	],
-	dtype=jnp.float32,
-)
-
-NF4_BOUNDARIES = jnp.array(
-	[
-		-float("inf"),
-		-0.8480964004993439,
-		-0.6106329262256622,
-		-0.4599952697753906,
-		-0.33967943489551544,
-		-0.23460740596055984,
-		-0.13791173323988914,
-		-0.045525018125772476,
-		0.03979014977812767,
-		0.1202552504837513,
-		0.2035212516784668,
-		0.2920137718319893,
-		0.3893125355243683,
-		0.5016634166240692,
-		0.6427869200706482,
-		0.8614784181118011,
-	],
-	dtype=jnp.float32,
-)
-
-
-@partial(jax.jit, static_argnames=["block_size"])
-def single_quantize_and_pack_nf4(blocks, block_size=64):
-	"""
-	Combined quantization and packing for better performance.
-	Handles normalization, quantization, and packing in a single operation.
-	"""
-	# Pad and reshape into blocks
-	blocks = blocks.reshape(-1, block_size)
-
-	# Compute absolute maximum for each block
-	absmax = jnp.max(jnp.abs(blocks), axis=1)
-
-	# Normalize blocks
-	normalized = blocks / absmax[:, None]
-
-	# Quantize using vectorized operations
-	quantized = jnp.searchsorted(NF4_BOUNDARIES, normalized.reshape(-1)) - 1
-
-	# Pack pairs efficiently using bit operations
-	quantized = quantized.reshape(-1, 2)
-	packed = (quantized[:, 0] << 4) | quantized[:, 1]
-
-	return packed.astype(jnp.uint8), absmax
-
-
-@partial(jax.jit, static_argnames=["block_size"])
-def single_dequantize_nf4(packed_values, absmax, block_size):
-	"""
-	Optimized dequantization combining unpacking and scaling in fewer operations.
-	"""
-	high = (packed_values >> 4) & 0xF
-	low = packed_values & 0xF
-	unpacked = jnp.stack([high, low], axis=1).reshape(-1)
-
-	dequantized = NF4_TABLE[unpacked]
 
-	num_blocks = len(absmax)
-	dequantized = dequantized.reshape(num_blocks, block_size)
-	scaled = dequantized * absmax[:, None]
-	return scaled
 
-
-@partial(jax.jit, static_argnames=["block_size"])
-def quantize_and_pack_nf4(blocks, block_size=64):
-	if blocks.ndim > 2:
-		return jax.vmap(quantize_and_pack_nf4, in_axes=(0, None), out_axes=(0, 0))(
-			blocks, block_size
-		)
-	return single_quantize_and_pack_nf4(blocks, block_size)
-
-
-@partial(jax.jit, static_argnames=["block_size"])
-def dequantize_nf4(packed_values, absmax, block_size):
-	if packed_values.ndim > 2:
-		return jax.vmap(dequantize_nf4, in_axes=(0, 0, None), out_axes=(0,))(
-			packed_values, absmax, block_size
-		)
-	return single_dequantize_nf4(packed_values, absmax, block_size)
+def _host_device(array: tp.Any) -> tp.Optional[tp.Any]:
+	"""Returns the single CPU device holding `array`, `None` if it lives elsewhere."""
+	if not isinstance(array, jax.Array) or isinstance(array, jax.core.Tracer):
+		return None
+	devices = array.devices()
+	if len(devices) != 1:
+		return None
+	(device,) = devices
+	return device if device.platform == "cpu" else None
 
 
 class LinearNF4(QauntModule):
@@ -161,6 +78,8 @@ class LinearNF4(QauntModule):
 		dot_general: DotGeneralT = lax.dot_general,
 		rngs: rnglib.Rngs,
 		block_size: int = 64,
+		cache_dequantized: bool = False,
+		double_quant: bool = False,
 	):
 		super().__init__(
 			dtype=dtype,
@@ -171,12 +90,17 @@ class LinearNF4(QauntModule):
 		if do_init:
 			kernel_key = rngs.params()
 			quant_kernel = kernel_init(kernel_key, (in_features, out_features), param_dtype)
-			quant_kernel, quant_scales = self._quantize_kernel(quant_kernel)
+			quant_kernel, quant_scales, quant_scales_scale = self._quantize_kernel(
+				quant_kernel,
+				block_size,
+				double_quant,
+			)
 		else:
-			quant_kernel, quant_scales = None, None
+			quant_kernel, quant_scales, quant_scales_scale = None, None, None
 
 		self.quant_kernel = nnx.Param(quant_kernel)
 		self.quant_scales = nnx.Param(quant_scales)
+		self.quant_scales_scale = nnx.Param(quant_scales_scale)
 
 		if use_bias and do_init:
 			bias_key = rngs.params()
@@ -184,6 +108,12 @@ class LinearNF4(QauntModule):
 		else:
 			self.bias = nnx.Param(None)
 
+		# keeps the dequantized kernel around when `cache_dequantized` is set, this
+		# trades the 4-bit memory saving for skipping the dequantization on every call.
+		# It is filled eagerly (`from_linear`, `refresh_dequant_caches`), never by
+		# `__call__`, since writes made inside a jitted forward are thrown away.
+		self._dequant_cache = nnx.Cache(None)
+
 		self.in_features = in_features
 		self.out_features = out_features
 		self.use_bias = use_bias
@@ -194,6 +124,8 @@ class LinearNF4(QauntModule):
 		self.bias_init = bias_init
 		self.dot_general = dot_general
 		self.block_size = block_size
+		self.cache_dequantized = cache_dequantized
+		self.double_quant = double_quant
 
 	@classmethod
 	def from_linear(
@@ -201,6 +133,8 @@ class LinearNF4(QauntModule):
 		linear: nnx.Linear,
 		rngs: tp.Optional[rnglib.Rngs] = None,
 		block_size: int = 128,
+		cache_dequantized: bool = False,
+		double_quant: bool = False,
 		**kwargs,
 	) -> "LinearNF4":
 		if rngs is None:
@@ -218,13 +152,23 @@ class LinearNF4(QauntModule):
 				bias_init=linear.bias_init,
 				dot_general=linear.dot_general,
 				block_size=block_size,
+				cache_dequantized=cache_dequantized,
+				double_quant=double_quant,
 				rngs=rngs,
 			)
 		)
 
-		quant_kernel, quant_scales = cls._quantize_kernel(linear.kernel.value, block_size)
+		quant_kernel, quant_scales, quant_scales_scale = cls._quantize_kernel(
+			linear.kernel.value,
+			block_size,
+			double_quant,
+		)
 		instance.quant_kernel = nnx.Param(quant_kernel)
 		instance.quant_scales = nnx.Param(quant_scales)
+		instance.quant_scales_scale = nnx.Param(quant_scales_scale)
+		instance._dequant_cache = nnx.Cache(None)
+		if cache_dequantized:
+			instance._dequant_cache.value = instance._dequantize_kernel()
 
 		if linear.use_bias:
 			instance.bias = nnx.Param(linear.bias.value)
@@ -259,11 +203,47 @@ class LinearNF4(QauntModule):
 		return linear
 
 	@staticmethod
-	def _quantize_kernel(quant_kernel, block_size):
-		"""Quantize the quant_kernel weights using NF4."""
+	def _quantize_kernel(quant_kernel, block_size, double_quant=False):
+		"""
+		Quantize the quant_kernel weights using NF4.
+
+		When every row holds whole blocks (`out_features % block_size == 0`) the
+		packed words and scales are kept kernel-shaped, `(in, out // 8)` and
+		`(in, out // block_size)`, so they shard along the same axes as the kernel.
+		"""
 		if quant_kernel is None or isinstance(quant_kernel, jax.ShapeDtypeStruct):
-			return None, None
-		return quantize_and_pack_nf4(quant_kernel, block_size)
+			return None, None, None
+		host_device = _host_device(quant_kernel)
+		if double_quant:
+			packed, scales, scales_scale = double_quantize_and_pack_nf4(
+				quant_kernel, block_size
+			)
+		elif isinstance(quant_kernel, np.ndarray) or host_device is not None:
+			# one-shot load-time path, skips tracing a program for every layer.
+			packed, scales = jax.device_put(
+				quantize_and_pack_nf4_numpy(np.asarray(quant_kernel), block_size),
+				host_device,
+			)
+			scales_scale = None
+		else:
+			(packed, scales), scales_scale = (
+				quantize_and_pack_nf4(quant_kernel, block_size),
+				None,
+			)
+		if quant_kernel.ndim == 2 and quant_kernel.shape[-1] % block_size == 0:
+			packed = packed.reshape(quant_kernel.shape[0], -1)
+			scales = scales.reshape(quant_kernel.shape[0], -1)
+		return packed, scales, scales_scale
+
+	def _get_scales(self):
+		"""Returns the per-block scales, undoing the double quantization if used."""
+		if self.quant_scales_scale.value is None:
+			return self.quant_scales.value
+		return dequantize_absmax(
+			self.quant_scales.value,
+			self.quant_scales_scale.value,
+			self.param_dtype,
+		)
 
 	def _dequantize_kernel(self):  # in case someone's using tie word embedding.
 		"""Dequantize the quant_kernel weights from NF4."""
@@ -277,37 +257,98 @@ class LinearNF4(QauntModule):
 			return self.quant_kernel
 		return dequantize_nf4(
 			self.quant_kernel.value,
-			self.quant_scales.value,
+			self._get_scales(),
 			self.block_size,
-		).reshape(self.in_features, self.out_features)
+			(self.in_features, self.out_features),
+		)
+
+	def _dequant_matmul(self, inputs: Array, dtype: tp.Optional[Dtype] = None) -> Array:
+		"""Multiplies `inputs` with the packed kernel, dequantizing it tile by tile."""
+		return dequantize_nf4_matmul(
+			inputs,
+			self.quant_kernel.value,
+			self._get_scales(),
+			out_features=self.out_features,
+			block_size=self.block_size,
+			dtype=dtype,
+			precision=self.precision,
+		)
 
 	@jax.named_scope("easydel-linear-nf4-call")
 	def __call__(self, inputs: Array) -> Array:
 		"""Applies a quantized linear transformation to the inputs along the last dimension."""
-		quant_kernel = self._dequantize_kernel()
-
-		assert (
-			quant_kernel is not None
-		), "loaded and dequantized quant_kernel is None, which means it have been loaded from another None Kernel Linear"
-
-		bias = self.bias.value
 
-		inputs, quant_kernel, bias = dtypes.promote_dtype(
-			(inputs, quant_kernel, bias), dtype=self.dtype
+		assert self.quant_kernel.value is not None, (
+			"quant_kernel is None, which means it have been loaded from another None Kernel Linear"
 		)
 
-		y = self.dot_general(
-			inputs,
-			quant_kernel,
-			(((inputs.ndim - 1,), (0,)), ((), ())),
-			precision=self.precision,
-		)
+		bias = self.bias.value
+		kernel = self._dequant_cache.value
+		if kernel is not None:
+			inputs, kernel, bias = dtypes.promote_dtype(
+				(inputs, kernel, bias), dtype=self.dtype
+			)
+			y = self.dot_general(
+				inputs,
+				kernel,
+				(((inputs.ndim - 1,), (0,)), ((), ())),
+				precision=self.precision,
+				preferred_element_type=jnp.float32,
+			).astype(inputs.dtype)
+		else:
+			inputs, bias = dtypes.promote_dtype((inputs, bias), dtype=self.dtype)
+			y = self._dequant_matmul(inputs, dtype=self.dtype)
 
 		assert self.use_bias == (bias is not None)
 		if bias is not None:
-			y += jnp.reshape(bias, (1,) * (y.ndim - 1) + (-1,))
+			y = y + bias
 		return y
 
+	@classmethod
+	def refresh_dequant_caches(cls, model: nnx.Module) -> None:
+		"""
+		Re-fills the dequantized-kernel cache of every `cache_dequantized` layer in
+		`model` from its current packed params, so replacing them (e.g. loading new
+		params) never leaves a stale kernel behind.
+		"""
+		cls.fill_dequant_caches(
+			[
+				module
+				for _, module in model.iter_modules()
+				if isinstance(module, cls)
+				and module.cache_dequantized
+				and isinstance(module.quant_kernel.value, jax.Array)
+			]
+		)
+
+	@staticmethod
+	def fill_dequant_caches(layers: tp.Sequence["LinearNF4"]) -> None:
+		"""
+		Fills the dequantized-kernel cache of every layer, same-shaped layers (e.g. the
+		`q_proj` of each decoder block) are stacked and dequantized in one program
+		instead of one launch per layer.
+		"""
+		groups = {}
+		for layer in layers:
+			key = (
+				layer.in_features,
+				layer.out_features,
+				layer.block_size,
+				layer.quant_kernel.value.shape,
+				layer._get_scales().shape,
+				layer._get_scales().dtype,
+			)
+			groups.setdefault(key, []).append(layer)
+		for (in_features, out_features, block_size, *_), group in groups.items():
+			kernels = dequantize_nf4_stacked(
+				jnp.stack([layer.quant_kernel.value for layer in group]),
+				jnp.stack([layer._get_scales() for layer in group]),
+				block_size,
+				(in_features, out_features),
+			)
+			for index, layer in enumerate(group):
+				layer._dequant_cache.value = kernels[index]
+
 	def get_kernel(self):
 		"""Get the dequantized quant_kernel weights."""
 		return self._dequantize_kernel()
@@ -316,10 +357,26 @@ class LinearNF4(QauntModule):
 		"""Get the quantized quant_kernel weights and quant_scales."""
 		return self.quant_kernel.value, self.quant_scales.value
 
+	@staticmethod
+	def derive_partition_rules(partition_rules):
+		"""
+		Reuses every `.../kernel` partition rule for the kernel-shaped `quant_kernel`
+		and `quant_scales` of the same layer, so packed weights shard along the
+		same axes as the kernel they replaced instead of falling back to replication.
+		"""
+		derived = []
+		for rule, spec in partition_rules:
+			if rule.endswith("kernel"):
+				derived.append((rule[: -len("kernel")] + "quant_(kernel|scales)$", spec))
+			derived.append((rule, spec))
+		return tuple(derived)
+
 	@staticmethod
 	def metadata():
 		return {"quant_mode": "nf4"}
 
 	@staticmethod
 	def quantization_mapping():
-		return {"kernel": ["quant_kernel", "quant_scales", "block_size"]}
+		return {
+			"kernel": ["quant_kernel", "quant_scales", "quant_scales_scale", "block_size"]
+		}
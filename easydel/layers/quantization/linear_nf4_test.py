@@ -0,0 +1,227 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+import pytest
+from flax import nnx
+from jax import numpy as jnp
+
+from easydel.utils.traversals import merge_model_and_tree
+
+from . import _nf4_quantizer
+from ._nf4_quantizer import (
+	NF4_TABLE,
+	dequantize_absmax,
+	dequantize_nf4,
+	dequantize_nf4_matmul,
+	quantize_and_pack_nf4,
+	quantize_and_pack_nf4_numpy,
+	quantize_absmax,
+)
+from .linear_nf4 import LinearNF4
+
+
+@pytest.fixture
+def kernel():
+	return jax.random.normal(jax.random.PRNGKey(0), (128, 256), dtype=jnp.float32)
+
+
+def test_round_trip_error_is_bounded(kernel):
+	packed, absmax = quantize_and_pack_nf4(kernel, 64)
+	restored = dequantize_nf4(packed, absmax, 64).reshape(kernel.shape)
+	blocks = kernel.reshape(-1, 64)
+	max_gap = np.max(np.diff(np.asarray(NF4_TABLE))) / 2
+	bound = (absmax[:, None] * max_gap).repeat(64, axis=1).reshape(kernel.shape)
+	assert np.all(np.abs(np.asarray(restored - kernel)) <= np.asarray(bound) + 1e-6)
+	assert absmax.shape == (blocks.shape[0],)
+
+
+def test_dequantize_matmul_matches_dequantized_kernel(kernel, monkeypatch):
+	monkeypatch.setattr(_nf4_quantizer, "_NF4_MATMUL_TILE_BYTES", 32 * 256 * 4)
+	_nf4_quantizer._get_tile_size.cache_clear()
+	packed, absmax = quantize_and_pack_nf4(kernel, 64)
+	inputs = jax.random.normal(jax.random.PRNGKey(1), (2, 3, 128))
+	expected = inputs @ dequantize_nf4(packed, absmax, 64).reshape(kernel.shape)
+	result = dequantize_nf4_matmul(
+		inputs, packed, absmax, out_features=256, block_size=64
+	)
+	np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-4)
+
+
+@pytest.mark.parametrize(
+	"in_features,out_features,itemsize,min_tiles",
+	[(4096, 4096, 2, 8), (4096, 14336, 2, 16), (14336, 4096, 4, 32)],
+)
+def test_tile_size_splits_real_shapes(in_features, out_features, itemsize, min_tiles):
+	tile_size = _nf4_quantizer._get_tile_size(in_features, out_features, 64, itemsize)
+	assert in_features % tile_size == 0
+	assert tile_size * out_features * itemsize <= _nf4_quantizer._NF4_MATMUL_TILE_BYTES
+	assert in_features // tile_size >= min_tiles
+
+
+def test_linear_nf4_from_linear(kernel):
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	linear.kernel.value = kernel
+	quantized = LinearNF4.from_linear(linear, block_size=64)
+	inputs = jax.random.normal(jax.random.PRNGKey(2), (4, 128))
+	expected = inputs @ quantized.get_kernel() + linear.bias.value
+	np.testing.assert_allclose(quantized(inputs), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_linear_nf4_cached_kernel_matches_fused_path(kernel):
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	linear.kernel.value = kernel
+	fused = LinearNF4.from_linear(linear, block_size=64)
+	cached = LinearNF4.from_linear(linear, block_size=64, cache_dequantized=True)
+	inputs = jax.random.normal(jax.random.PRNGKey(3), (4, 128))
+	np.testing.assert_allclose(cached(inputs), fused(inputs), rtol=1e-5, atol=1e-4)
+	assert cached._dequant_cache.value is not None
+	assert fused._dequant_cache.value is None
+
+
+def test_loading_params_refreshes_dequant_cache(kernel):
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	cached = LinearNF4.from_linear(linear, block_size=64, cache_dequantized=True)
+	linear.kernel.value = kernel
+	fresh = LinearNF4.from_linear(linear, block_size=64)
+	cached = merge_model_and_tree(cached, nnx.state(fresh, nnx.Param).to_pure_dict())
+	np.testing.assert_array_equal(cached._dequant_cache.value, fresh.get_kernel())
+
+
+def test_round_trip_keeps_leading_dimensions(kernel):
+	stacked = kernel.reshape(2, 64, 256)
+	packed, absmax = quantize_and_pack_nf4(stacked, 64)
+	assert absmax.shape == (2, 256)
+	restored = dequantize_nf4(packed, absmax, 64)
+	flat = dequantize_nf4(*quantize_and_pack_nf4(kernel, 64), 64)
+	np.testing.assert_array_equal(restored.reshape(-1), flat.reshape(-1))
+
+
+def test_round_trip_unaligned_leading_slices():
+	stacked = jax.random.normal(jax.random.PRNGKey(6), (2, 3, 32))
+	packed, absmax = quantize_and_pack_nf4(stacked, 64)
+	assert absmax.shape == (3,)
+	restored = dequantize_nf4(packed, absmax, 64, stacked.shape)
+	flat = dequantize_nf4(*quantize_and_pack_nf4(stacked.reshape(-1), 64), 64, (2, 3, 32))
+	np.testing.assert_array_equal(restored, flat)
+
+
+def test_dequantize_has_no_interleave_shuffle(kernel):
+	packed, absmax = quantize_and_pack_nf4(kernel, 64)
+	jaxpr = str(jax.make_jaxpr(lambda p, a: dequantize_nf4(p, a, 64))(packed, absmax))
+	assert "concatenate" not in jaxpr
+	assert "transpose" not in jaxpr
+	assert jaxpr.count("gather[") == 1
+
+
+def test_linear_nf4_double_quant(kernel):
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	linear.kernel.value = kernel
+	single = LinearNF4.from_linear(linear, block_size=64)
+	double = LinearNF4.from_linear(linear, block_size=64, double_quant=True)
+	assert double.quant_scales.value.dtype == jnp.uint8
+	single_error = jnp.abs(single.get_kernel() - kernel).mean()
+	double_error = jnp.abs(double.get_kernel() - kernel).mean()
+	assert double_error < single_error * 1.1
+
+
+def test_quantize_absmax_pads_partial_groups():
+	absmax = jnp.abs(jax.random.normal(jax.random.PRNGKey(8), (257,)))
+	absmax_q, absmax_scale = quantize_absmax(absmax)
+	assert absmax_q.shape == (257,)
+	assert absmax_scale.shape == (2,)
+	restored = dequantize_absmax(absmax_q, absmax_scale, jnp.float32)
+	assert bool(jnp.all(restored >= absmax))
+	np.testing.assert_allclose(restored, absmax, atol=float(absmax_scale.max()))
+
+
+def test_linear_nf4_kernel_shaped_layout(kernel, monkeypatch):
+	monkeypatch.setattr(_nf4_quantizer, "_NF4_MATMUL_TILE_BYTES", 32 * 256 * 4)
+	_nf4_quantizer._get_tile_size.cache_clear()
+	linear = nnx.Linear(128, 256, rngs=nnx.Rngs(0))
+	linear.kernel.value = kernel
+	quantized = LinearNF4.from_linear(linear, block_size=64)
+	assert quantized.quant_kernel.value.shape == (128, 256 // 8)
+	assert quantized.quant_scales.value.shape == (128, 256 // 64)
+	inputs = jax.random.normal(jax.random.PRNGKey(4), (3, 128))
+	expected = inputs @ quantized.get_kernel() + linear.bias.value
+	np.testing.assert_allclose(quantized(inputs), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_derive_partition_rules():
+	spec = jax.sharding.PartitionSpec("fsdp", "tp")
+	rules = LinearNF4.derive_partition_rules((("mlp/up_proj/kernel", spec),))
+	assert rules[0] == ("mlp/up_proj/quant_(kernel|scales)$", spec)
+	assert rules[1] == ("mlp/up_proj/kernel", spec)
+
+
+def test_numpy_quantizer_matches_jax(kernel):
+	packed, absmax = quantize_and_pack_nf4(kernel, 64)
+	packed_np, absmax_np = quantize_and_pack_nf4_numpy(np.asarray(kernel), 64)
+	np.testing.assert_array_equal(np.asarray(packed), packed_np)
+	np.testing.assert_array_equal(np.asarray(absmax), absmax_np)
+
+
+@pytest.mark.parametrize("shape", [(2, 64, 256), (2, 3, 32)])
+def test_numpy_quantizer_matches_jax_leading_dimensions(shape):
+	stacked = jax.random.normal(jax.random.PRNGKey(7), shape)
+	packed, absmax = quantize_and_pack_nf4(stacked, 64)
+	packed_np, absmax_np = quantize_and_pack_nf4_numpy(np.asarray(stacked), 64)
+	assert packed_np.shape == packed.shape
+	assert absmax_np.shape == absmax.shape
+	np.testing.assert_array_equal(np.asarray(packed), packed_np)
+	np.testing.assert_array_equal(np.asarray(absmax), absmax_np)
+
+
+def test_chunked_dequantize_matches_single_pass(kernel, monkeypatch):
+	packed, absmax = quantize_and_pack_nf4(kernel, 64)
+	expected = dequantize_nf4(packed, absmax, 64)
+	# 3 rows per chunk, which leaves a remainder on the 512 block rows.
+	monkeypatch.setattr(_nf4_quantizer, "_NF4_DEQUANTIZE_CHUNK_ELEMENTS", 64 * 3)
+	chunked = jax.jit(dequantize_nf4.__wrapped__, static_argnums=2)(packed, absmax, 64)
+	np.testing.assert_array_equal(chunked, expected)
+
+
+def test_linear_nf4_pads_odd_shapes():
+	linear = nnx.Linear(100, 30, rngs=nnx.Rngs(0))
+	quantized = LinearNF4.from_linear(linear, block_size=64)
+	assert quantized.quant_scales.value.shape == (-(-100 * 30 // 64),)
+	inputs = jax.random.normal(jax.random.PRNGKey(5), (2, 100))
+	kernel = quantized.get_kernel()
+	assert kernel.shape == (100, 30)
+	np.testing.assert_allclose(
+		quantized(inputs),
+		inputs @ kernel + linear.bias.value,
+		rtol=1e-5,
+		atol=1e-4,
+	)
+	packed, absmax = quantize_and_pack_nf4(linear.kernel.value, 64)
+	packed_np, absmax_np = quantize_and_pack_nf4_numpy(
+		np.asarray(linear.kernel.value), 64
+	)
+	np.testing.assert_array_equal(np.asarray(packed), packed_np)
+
+
+def test_fill_dequant_caches_matches_per_layer():
+	layers = [
+		LinearNF4.from_linear(nnx.Linear(128, 256, rngs=nnx.Rngs(seed)), block_size=64)
+		for seed in range(3)
+	]
+	layers.append(
+		LinearNF4.from_linear(nnx.Linear(100, 30, rngs=nnx.Rngs(3)), block_size=64)
+	)
+	LinearNF4.fill_dequant_caches(layers)
+	for layer in layers:
+		np.testing.assert_array_equal(layer._dequant_cache.value, layer.get_kernel())
@@ -0,0 +1,198 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import typing as tp
+
+import jax
+import jax.numpy as jnp
+from flax import nnx
+from flax.nnx import rnglib
+from flax.nnx.nn import initializers
+from flax.typing import (
+	Dtype,
+	Initializer,
+	PrecisionLike,
+)
+from jax import lax
+
+from .base_quant import QauntModule
+
+Array = jax.Array
+
+default_kernel_init = initializers.lecun_normal()
+default_bias_init = initializers.zeros_init()
+
+_TERNARY_SHIFTS = jnp.array([0, 2, 4, 6], dtype=jnp.uint8)
+
+
+def quantize_ternary(kernel):
+	"""
+	Quantize a `(in_features, out_features)` kernel to {-1, 0, 1} with a single
+	absmean scale, packing four 2-bit weights per uint8 along the input axis.
+	"""
+	kernel = kernel.astype(jnp.float32)
+	scale = jnp.clip(jnp.abs(kernel).mean(), min=1e-5)
+	quants = jnp.clip(jnp.round(kernel / scale), -1, 1).astype(jnp.int8)
+	# pad rows hold the code for 0, so they contribute nothing once unpacked.
+	quants = jnp.pad(quants, ((0, -quants.shape[0] % 4), (0, 0)))
+	codes = (quants + 1).astype(jnp.uint8).reshape(-1, 4, quants.shape[-1])
+	# the 2-bit fields never overlap, so the sum is a bitwise or.
+	packed = (codes << _TERNARY_SHIFTS[None, :, None]).sum(axis=1, dtype=jnp.uint8)
+	return packed, scale.reshape(1)
+
+
+def unpack_ternary(packed, in_features: int):
+	"""Unpack uint8 codes back into an int8 `(in_features, out_features)` kernel."""
+	codes = (packed[:, None, :] >> _TERNARY_SHIFTS[None, :, None]) & 3
+	return codes.reshape(-1, packed.shape[-1])[:in_features].astype(jnp.int8) - 1
+
+
+def quantize_activations_int8(x):
+	"""Per-token absmax int8 quantization over the last axis."""
+	scale = jnp.clip(jnp.abs(x.astype(jnp.float32)).max(-1, keepdims=True), min=1e-5)
+	scale = scale / 127
+	return jnp.clip(jnp.round(x / scale), -128, 127).astype(jnp.int8), scale
+
+
+class LinearTernary(QauntModule):
+	"""
+	BitNet-style linear layer with ternary {-1, 0, 1} weights and int8 per-token
+	activations, contracted in int32.
+	"""
+
+	def __init__(
+		self,
+		in_features: int,
+		out_features: int,
+		*,
+		use_bias: bool = True,
+		dtype: tp.Optional[Dtype] = None,
+		param_dtype: Dtype = jnp.float32,
+		precision: PrecisionLike = None,
+		do_init: bool = False,
+		kernel_init: Initializer = default_kernel_init,
+		bias_init: Initializer = default_bias_init,
+		rngs: rnglib.Rngs,
+	):
+		super().__init__(
+			dtype=dtype,
+			param_dtype=param_dtype,
+			precision=precision,
+		)
+		if do_init:
+			kernel = kernel_init(rngs.params(), (in_features, out_features), param_dtype)
+			quantized_kernel, quant_scales = self._quantize_kernel(kernel)
+		else:
+			quantized_kernel, quant_scales = None, None
+
+		self.quant_kernel = nnx.Param(quantized_kernel)
+		self.quant_scales = nnx.Param(quant_scales)
+
+		if use_bias and do_init:
+			self.bias = nnx.Param(bias_init(rngs.params(), (out_features,), param_dtype))
+		else:
+			self.bias = nnx.Param(None)
+
+		self.in_features = in_features
+		self.out_features = out_features
+		self.use_bias = use_bias
+		self.kernel_init = kernel_init
+		self.bias_init = bias_init
+
+	@classmethod
+	def from_linear(
+		cls,
+		linear: nnx.Linear,
+		rngs: tp.Optional[rnglib.Rngs] = None,
+		**kwargs,
+	) -> "LinearTernary":
+		"""
+		Create a LinearTernary module from a regular Linear module; the absmean
+		weight scale is calibrated once here.
+
+		Args:
+				linear: The source Linear module
+				rngs: Random number generator state
+
+		Returns:
+				A new LinearTernary module with packed ternary weights
+		"""
+		if rngs is None:
+			rngs = nnx.Rngs(0)
+		instance = nnx.eval_shape(
+			lambda: cls(
+				in_features=linear.in_features,
+				out_features=linear.out_features,
+				use_bias=linear.use_bias,
+				dtype=linear.dtype,
+				param_dtype=linear.param_dtype,
+				precision=linear.precision,
+				kernel_init=linear.kernel_init,
+				bias_init=linear.bias_init,
+				rngs=rngs,
+			)
+		)
+		quantized_kernel, quant_scales = cls._quantize_kernel(linear.kernel.value)
+		instance.quant_kernel = nnx.Param(quantized_kernel)
+		instance.quant_scales = nnx.Param(quant_scales)
+		if linear.use_bias:
+			instance.bias = nnx.Param(linear.bias.value)
+		return instance
+
+	@staticmethod
+	def _quantize_kernel(kernel):
+		"""Quantize the kernel weights."""
+		if kernel is None or isinstance(kernel, jax.ShapeDtypeStruct):
+			return None, None
+		return quantize_ternary(kernel)
+
+	def _dequantize_kernel(self):
+		"""Dequantize the kernel weights."""
+		if self.quant_kernel.value is None:
+			return None
+		kernel = unpack_ternary(self.quant_kernel.value, self.in_features)
+		return (kernel * self.quant_scales.value).astype(self.param_dtype)
+
+	@jax.named_scope("easydel-linear-ternary-call")
+	def __call__(self, inputs: Array) -> Array:
+		"""int8 x ternary matmul accumulated in int32, rescaled afterwards."""
+		dtype = self.dtype or inputs.dtype
+		quant_inputs, input_scales = quantize_activations_int8(inputs)
+		out = lax.dot_general(
+			quant_inputs,
+			unpack_ternary(self.quant_kernel.value, self.in_features),
+			(((inputs.ndim - 1,), (0,)), ((), ())),
+			preferred_element_type=jnp.int32,
+		)
+		out = out.astype(jnp.float32) * (input_scales * self.quant_scales.value)
+		if self.use_bias:
+			out = out + self.bias.value
+		return out.astype(dtype)
+
+	def get_kernel(self):
+		"""Get the dequantized kernel weights."""
+		return self._dequantize_kernel()
+
+	def get_quantized_kernel(self):
+		"""Get the packed ternary kernel and its scale."""
+		return self.quant_kernel.value, self.quant_scales.value
+
+	@staticmethod
+	def metadata():
+		return {"quant_mode": "ternary"}
+
+	@staticmethod
+	def quantization_mapping():
+		return {"kernel": ["quant_kernel", "quant_scales"]}
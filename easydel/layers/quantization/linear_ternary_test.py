@@ -0,0 +1,39 @@
+# Copyright 2023 The EASYDEL Author @erfanzar (Erfan Zare Chavoshi).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+from flax import nnx
+from jax import numpy as jnp
+
+from .linear_ternary import LinearTernary, quantize_ternary, unpack_ternary
+
+
+def test_ternary_pack_round_trip():
+	kernel = jax.random.normal(jax.random.PRNGKey(0), (130, 64))
+	packed, scale = quantize_ternary(kernel)
+	assert packed.dtype == jnp.uint8
+	assert packed.shape == (33, 64)
+	expected = jnp.clip(jnp.round(kernel / scale), -1, 1)
+	np.testing.assert_array_equal(unpack_ternary(packed, 130), expected)
+
+
+def test_linear_ternary_from_linear():
+	linear = nnx.Linear(128, 64, rngs=nnx.Rngs(0))
+	quantized = LinearTernary.from_linear(linear)
+	inputs = jax.random.normal(jax.random.PRNGKey(1), (2, 3, 128))
+	expected = inputs @ quantized.get_kernel() + linear.bias.value
+	outputs = quantized(inputs)
+	assert outputs.dtype == inputs.dtype
+	assert jnp.abs(outputs - expected).max() / jnp.abs(expected).max() < 0.05
@@ -22,8 +22,11 @@ from flax import nnx as nn
 import tqdm
 
 from easydel.infra.etils import EasyDeLPlatforms, EasyDeLQuantizationMethods
+from .embed_8bit import Embed8bit
 from .linear_8bit import Linear8bit
+from .linear_fp8 import ArrayFP8, LinearFP8
 from .linear_nf4 import LinearNF4
+from .linear_ternary import LinearTernary
 
 DEFAULT_QUANTIZATION_PATTERN = (
 	"(wo|wq|wk|wv|q_proj|k_proj|v_proj|o_proj|w1|w2|w3|"
@@ -34,6 +37,8 @@ DEFAULT_QUANTIZATION_PATTERN = (
 METHOD_TO_LINEAR_MAPPING = {
 	EasyDeLQuantizationMethods.NF4: LinearNF4,
 	EasyDeLQuantizationMethods.A8BIT: Linear8bit,
+	EasyDeLQuantizationMethods.FP8: LinearFP8,
+	EasyDeLQuantizationMethods.TERNARY: LinearTernary,
 }
 
 
@@ -54,6 +59,8 @@ class EasyQuantizer:
 		match self.quantization_method:
 			case EasyDeLQuantizationMethods.A8BIT:
 				return Array8B(array=array)
+			case EasyDeLQuantizationMethods.FP8:
+				return ArrayFP8(array=array)
 			case EasyDeLQuantizationMethods.NF4:
 				should_be_quantized = True
 				if array.size % self.block_size != 0:
@@ -128,3 +135,44 @@ class EasyQuantizer:
 					)
 				pbar.update(1)
 		return model
+
+	def quantize_embeddings(
+		self,
+		model: nn.Module,
+		/,
+		*,
+		quantization_pattern: tp.Optional[str] = None,
+		verbose: bool = True,
+	) -> nn.Module:
+		"""
+		Replace embedding tables with int8 weight-only `Embed8bit` modules.
+
+		Embeddings are always stored as int8 with per-row scales, independent of
+		`quantization_method`, since lookups and tied output projections stay
+		memory-bound in either case.
+
+		Args:
+				model: The model to quantize.
+				quantization_pattern (str): re pattern for embeddings to be quantized.
+				verbose (bool): whenever to use tqdm for logging stuff.
+
+		Returns:
+				The model with its matching embeddings replaced.
+		"""
+		from easydel.utils.graph_utils import (
+			get_module_from_path,
+			iter_module_search,
+			set_module_from_path,
+		)
+
+		pattern = re.compile(quantization_pattern or ".*")
+		paths = [p[0] for p in iter_module_search(model, nn.Embed)]
+		for path in tqdm.tqdm(paths, desc="Quantizing embeddings", disable=not verbose):
+			if pattern.search(".".join([str(p) for p in path])):
+				embed = get_module_from_path(model=model, path=path)
+				set_module_from_path(
+					model=model,
+					path=path,
+					new_value=Embed8bit.from_embed(embed),
+				)
+		return model
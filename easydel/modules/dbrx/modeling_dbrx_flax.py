@@ -15,11 +15,12 @@
 
 import math
 import typing as tp
-from functools import cached_property
+from functools import cached_property, lru_cache
 
 import chex
 import jax
 import jax.numpy as jnp
+from eformer.jaximus import ArrayValue
 from flax import nnx as nn
 
 from easydel.infra.base_module import EasyDeLBaseModule
@@ -32,12 +33,15 @@ from easydel.infra.modeling_outputs import (
 )
 from easydel.infra.utils import (
 	ACT2FN,
+	ModuleCaches,
 	auto_remat,
 	control_mlp_sharding,
 	get_dot_general_by_bits,
 )
 from easydel.layers.attention import FlaxAttentionModule, FlexibleAttentionModule
 from easydel.layers.caching import TransformerCache, TransformerCacheView
+from easydel.layers.norms import fused_residual_layernorm
+from easydel.layers.rotary_embedding import get_frequencies
 from easydel.modules.dbrx.dbrx_configuration import (
 	DbrxAttentionConfig as DbrxAttentionConfig,
 )
@@ -45,6 +49,31 @@ from easydel.modules.dbrx.dbrx_configuration import DbrxConfig as DbrxConfig
 from easydel.modules.dbrx.dbrx_configuration import DbrxFFNConfig as DbrxFFNConfig
 
 
+@lru_cache(maxsize=16)
+def _get_frequencies(
+	head_size: int,
+	rotary_dim: int,
+	max_position: int,
+	base: float,
+	rope_scaling: tp.Optional[tp.Dict[str, tp.Any]],
+	dtype: jnp.dtype = jnp.float32,
+) -> jax.Array:
+	"""
+	RoPE tables only depend on these values, so every model built with them shares a
+	single concrete table (evaluated eagerly, even when first requested under a trace).
+	The table is computed in float32 and stored in `dtype`, cos / sin stay in [-1, 1]
+	so half precision storage keeps the rotation in the activations' dtype.
+	"""
+	with jax.ensure_compile_time_eval():
+		return get_frequencies(
+			head_size=head_size,
+			rotary_dim=rotary_dim,
+			max_position=max_position,
+			base=base,
+			rope_scaling=rope_scaling,
+		).astype(dtype)
+
+
 class DbrxAttention(FlaxAttentionModule):
 	def __init__(
 		self,
@@ -94,10 +123,14 @@ class DbrxAttention(FlaxAttentionModule):
 			**get_dot_general_by_bits(config.bits, config.easy_method),
 		)
 
+		head_dim = config.hidden_size // config.num_attention_heads
+		assert head_dim == self.head_dim, (
+			"`hidden_size // num_attention_heads` must match `d_model // n_heads`."
+		)
 		self.rotary = self.config.get_basic_rope(
 			dtype=self.dtype,
-			rotary_dim=self.config.hidden_size // self.config.num_attention_heads,
-			head_size=self.config.hidden_size // self.config.num_attention_heads,
+			rotary_dim=head_dim,
+			head_size=head_dim,
 			is_neox_style=True,
 			base=self.config.attn_config.rope_theta,
 		)
@@ -153,28 +186,19 @@ class DbrxAttention(FlaxAttentionModule):
 				max=self.config.attn_config.clip_qkv,
 			)
 
-		query_size = self.hidden_size
-		key_size = self.num_key_value_heads * self.head_dim
-
-		query_states, key_value_states = jnp.split(qkv_states, [query_size], axis=2)
-		key_states, value_states = jnp.split(key_value_states, [key_size], axis=2)
-		query_states = query_states.reshape(
+		qkv_states = qkv_states.reshape(
 			batch_size,
 			sequence_length,
-			self.num_attention_heads,
+			self.num_attention_heads + 2 * self.num_key_value_heads,
 			self.head_dim,
 		)
-		key_states = key_states.reshape(
-			batch_size,
-			sequence_length,
-			self.num_key_value_heads,
-			self.head_dim,
-		)
-		value_states = value_states.reshape(
-			batch_size,
-			sequence_length,
-			self.num_key_value_heads,
-			self.head_dim,
+		query_states, key_states, value_states = jnp.split(
+			qkv_states,
+			[
+				self.num_attention_heads,
+				self.num_attention_heads + self.num_key_value_heads,
+			],
+			axis=2,
 		)
 
 		query_states, key_states = self.rotary(
@@ -205,7 +229,9 @@ class DbrxAttention(FlaxAttentionModule):
 			bias=attention_bias,
 			attention_mask=attention_mask,
 			causal=True,
-			dropout_rng=self.rngs.params(),
+			dropout_rng=(
+				self.rngs.params() if self.config.attn_config.attn_pdrop > 0 else None
+			),
 			query_sequence_length=query_states.shape[1],
 			key_value_sequence_length=key_states.shape[1],
 			uses_cache=cache_view is not None,
@@ -219,10 +245,11 @@ class DbrxAttention(FlaxAttentionModule):
 		attn_output = self.out_proj(attn_output)
 
 		attn_output = self.resid_dropout(attn_output)
-		outputs = (attn_output,)
-		if output_attentions:
-			outputs += (output_attentions,)
-		return outputs
+		return (
+			(attn_output, attentions.attention_weights)
+			if output_attentions
+			else (attn_output, None)
+		)
 
 
 class DbrxNormAttentionNorm(nn.Module):
@@ -299,7 +326,7 @@ class DbrxNormAttentionNorm(nn.Module):
 		residual_states = hidden_states
 		hidden_states = self.norm_1(hidden_states)
 
-		attn_out = self.attn(
+		hidden_states, attn_weights = self.attn(
 			hidden_states=hidden_states,
 			attention_mask=attention_mask,
 			position_ids=position_ids,
@@ -310,12 +337,14 @@ class DbrxNormAttentionNorm(nn.Module):
 			frequencies=frequencies,
 			cache_view=cache_view,
 		)
-		hidden_states, attn_weights = attn_out if output_attentions else (attn_out[0], None)
 		hidden_states = self.dropout(hidden_states)
-		hidden_states = hidden_states + residual_states
-
-		residual_states = hidden_states
-		hidden_states = self.norm_2(hidden_states)
+		residual_states, hidden_states = fused_residual_layernorm(
+			residual_states,
+			hidden_states,
+			self.norm_2.scale.value,
+			epsilon=self.norm_2.epsilon,
+			dtype=self.dtype,
+		)
 
 		return residual_states, hidden_states, attn_weights
 
@@ -345,35 +374,49 @@ class DbrxExpertGLU(nn.Module):
 		self.v1 = nn.Param(init_fn(rngs.params(), shape, self.param_dtype))
 		self.w2 = nn.Param(init_fn(rngs.params(), shape, self.param_dtype))
 		self.activation_fn = ACT2FN[self.config.ffn_config.ffn_act_fn["name"]]
-
-	def __call__(self, x: chex.Array, expert_idx: int) -> chex.Array:
-		expert_shape = (
+		self.expert_shape = (
 			self.config.ffn_config.moe_num_experts,
 			self.config.ffn_config.ffn_hidden_size,
 			self.config.d_model,
 		)
-		expert_w1 = self.w1.value.reshape(expert_shape)[expert_idx]
-		expert_v1 = self.v1.value.reshape(expert_shape)[expert_idx]
-		expert_w2 = self.w2.value.reshape(expert_shape)[expert_idx]
 
-		x1 = jnp.matmul(
+	def expert_weights(self) -> tp.Tuple[chex.Array, chex.Array, chex.Array]:
+		"""
+		Returns `w1`, `v1` and `w2` viewed as `(experts, ffn_hidden, d_model)`, the
+		parameters keep the flat checkpoint layout so the view is a free reshape.
+		Weights loaded as quantized tensors (e.g. int8 rows with one scale per expert
+		channel) are dequantized here, right where the grouped matmuls consume them.
+		"""
+		weights = []
+		for param in (self.w1, self.v1, self.w2):
+			weight = param.value
+			if isinstance(weight, ArrayValue):
+				weight = weight.materialize()
+			weights.append(weight.reshape(self.expert_shape).astype(self.dtype))
+		return tuple(weights)
+
+	def __call__(self, x: chex.Array, group_sizes: chex.Array) -> chex.Array:
+		"""
+		Runs the expert GLU over token rows sorted by expert, `group_sizes[e]` rows
+		in a row go to expert `e`, so each expert only multiplies its own tokens.
+		"""
+		x = x.astype(self.dtype)
+		w1, v1, w2 = self.expert_weights()
+
+		x1 = jax.lax.ragged_dot(
 			x,
-			jnp.expand_dims(expert_w1.T, 0),
+			w1.transpose(0, 2, 1),
+			group_sizes,
 			precision=self.precision,
 		)
-		x2 = jnp.matmul(
+		x2 = jax.lax.ragged_dot(
 			x,
-			jnp.expand_dims(expert_v1.T, 0),
+			v1.transpose(0, 2, 1),
+			group_sizes,
 			precision=self.precision,
 		)
-		x1 = self.activation_fn(x1)
-		x1 = x1 * x2
-		x1 = jnp.matmul(
-			x1,
-			jnp.expand_dims(expert_w2, 0),
-			precision=self.precision,
-		)
-		return x1
+		x1 = self.activation_fn(x1) * x2
+		return jax.lax.ragged_dot(x1, w2, group_sizes, precision=self.precision)
 
 
 class DbrxExperts(nn.Module):
@@ -407,14 +450,29 @@ class DbrxExperts(nn.Module):
 		top_weights: chex.Array,
 		top_experts: chex.Array,
 	):
-		final_hidden_state = jnp.zeros_like(x)
-		for index in range(self.config.ffn_config.moe_num_experts):
-			output_moe_layer = self.mlp(x, index)
-			final_hidden_state += (
-				jnp.sum(jnp.multiply(index == top_experts, top_weights), axis=-1)[:, :, None]
-				* output_moe_layer
-			)
-		return final_hidden_state
+		batch_size, sequence_length, hidden_size = x.shape
+		top_k = top_experts.shape[-1]
+		flat_experts = top_experts.reshape(-1)
+		# sorts the (token, expert) assignments by expert so each expert sees a
+		# contiguous group of rows, then restores the token order afterwards.
+		order = jnp.argsort(flat_experts, stable=True)
+		group_sizes = jnp.bincount(
+			flat_experts,
+			length=self.config.ffn_config.moe_num_experts,
+		).astype(jnp.int32)
+		tokens = x.reshape(-1, hidden_size)[order // top_k]
+		expert_out = self.mlp(tokens, group_sizes)
+		inverse_order = jnp.zeros_like(order).at[order].set(
+			jnp.arange(order.shape[0], dtype=order.dtype),
+			unique_indices=True,
+		)
+		selected = expert_out[inverse_order].reshape(
+			batch_size,
+			sequence_length,
+			top_k,
+			hidden_size,
+		)
+		return jnp.einsum("bskd,bsk->bsd", selected, top_weights, precision=self.precision)
 
 
 class DbrxRouter(nn.Module):
@@ -460,33 +518,46 @@ class DbrxRouter(nn.Module):
 		noise = jax.random.normal(self.make_rng("params"), x.shape, dtype=x.dtype)
 		return low + noise * (high - low)
 
+	def _normalize_expert_weights(self, top_weights: chex.Array) -> chex.Array:
+		"""
+		Divides the top-k weights by their `moe_normalize_expert_weights`-norm, the
+		common orders are written out since the softmax weights are non-negative.
+		"""
+		order = int(self.moe_normalize_expert_weights)
+		if order == 1:
+			return top_weights / top_weights.sum(-1, keepdims=True)
+		if order == 2:
+			return top_weights * jax.lax.rsqrt(
+				jnp.square(top_weights).sum(-1, keepdims=True)
+			)
+		return top_weights / jnp.linalg.norm(
+			top_weights,
+			ord=order,
+			axis=-1,
+			keepdims=True,
+		)
+
 	def __call__(
 		self, x: chex.Array, deterministic: bool = True
 	) -> tp.Tuple[chex.Array, chex.Array, chex.Array]:
 		if not deterministic and self.moe_jitter_eps is not None:
 			x = x * self.jitter(x)
 
-		weights = self.layer(x.astype(jnp.promote_types(self.dtype, jnp.float32)))
-		weights = jax.nn.softmax(weights.astype(jnp.promote_types(self.dtype, jnp.float32)))
+		# the router matmul runs in `dtype`, only the softmax / top-k are upcast to
+		# float32 since that is where the routing decision is numerically sensitive.
+		weights = self.layer(x)
+		weights = jax.nn.softmax(weights.astype(jnp.float32), axis=-1)
 		top_weights, top_experts = jax.lax.top_k(weights, self.moe_top_k)
 
 		if self.moe_normalize_expert_weights:
-			top_weights = top_weights / jnp.linalg.norm(
-				top_weights,
-				ord=int(self.moe_normalize_expert_weights),
-				axis=-1,
-				keepdims=True,
-			)
+			top_weights = self._normalize_expert_weights(top_weights)
 
 		if self.uniform_expert_assignment:
 			top_experts = jax.lax.stop_gradient(
 				(
 					jnp.arange(
 						0,
-						jnp.prod(
-							jnp.asarray(top_experts.shape, dtype=jnp.int32),
-							dtype=jnp.int32,
-						),
+						math.prod(top_experts.shape),
 						dtype=top_experts.dtype,
 					)
 					% self.moe_num_experts
@@ -529,9 +600,10 @@ class DbrxFFN(nn.Module):
 			precision=precision,
 			rngs=rngs,
 		)
+		self.partition_axis = config.partition_axis
 
 	def __call__(self, x: chex.Array) -> tp.Tuple[chex.Array, chex.Array]:
-		x = control_mlp_sharding(x, self.config.partition_axis)
+		x = control_mlp_sharding(x, self.partition_axis)
 		weights, top_weights, top_experts = self.router(x)
 		out = self.experts(x, weights, top_weights, top_experts)
 		return out, weights
@@ -555,21 +627,14 @@ class DbrxBlock(nn.Module):
 		self.rngs = rngs
 		self.hidden_size = self.config.d_model
 		self.resid_pdrop = self.config.resid_pdrop
-		attn_block = DbrxNormAttentionNorm
-		ffn_block = DbrxFFN
-		attn_block, ffn_block = auto_remat(
-			attn_block,
-			ffn_block,
-			policy=config.gradient_checkpointing,
-		)
-		self.norm_attn_norm = attn_block(
+		self.norm_attn_norm = DbrxNormAttentionNorm(
 			config=config,
 			dtype=dtype,
 			param_dtype=param_dtype,
 			precision=precision,
 			rngs=rngs,
 		)
-		self.ffn = ffn_block(
+		self.ffn = DbrxFFN(
 			config=config,
 			dtype=dtype,
 			param_dtype=param_dtype,
@@ -669,8 +734,14 @@ class DbrxModel(EasyDeLBaseModule):
 			param_dtype=param_dtype,
 			rngs=rngs,
 		)
+		# the whole block is rematerialized as one unit, so the residual stream between
+		# attention and the experts is not saved or recomputed at a separate boundary.
+		(block,) = auto_remat(
+			DbrxBlock,
+			policy=config.gradient_checkpointing,
+		)
 		self.blocks = [
-			DbrxBlock(
+			block(
 				config=config,
 				dtype=dtype,
 				param_dtype=param_dtype,
@@ -689,10 +760,16 @@ class DbrxModel(EasyDeLBaseModule):
 
 	@cached_property
 	def frequencies(self):
-		return self.config.get_basic_frequencies(
-			rotary_dim=self.config.hidden_size // self.config.num_attention_heads,
-			head_size=self.config.hidden_size // self.config.num_attention_heads,
-			base=self.config.attn_config.rope_theta,
+		head_dim = self.config.hidden_size // self.config.num_attention_heads
+		return ModuleCaches(
+			_get_frequencies(
+				head_size=head_dim,
+				rotary_dim=head_dim,
+				max_position=self.config.granted_freq_max_position_embedding,
+				base=self.config.attn_config.rope_theta,
+				rope_scaling=self.config._get_rope_config().to_dict(),
+				dtype=jnp.dtype(self.dtype),
+			)
 		)
 
 	def __call__(
@@ -743,9 +820,9 @@ class DbrxModel(EasyDeLBaseModule):
 			else self.config.output_hidden_states
 		)
 		hidden_states = inputs_embeds
-		all_hidden_states = ()
-		all_router_logits = ()
-		all_attentions = ()
+		all_hidden_states = () if output_hidden_states else None
+		all_router_logits = () if output_router_logits else None
+		all_attentions = () if output_attentions else None
 		if past_key_values is None:
 			past_key_values = TransformerCache.init_empty(len(self.blocks))
 		for idx, block in enumerate(self.blocks):
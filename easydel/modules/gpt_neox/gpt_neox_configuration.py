@@ -67,6 +67,9 @@ class GPTNeoXConfig(EasyDeLBaseConfig):
 	        The gradient checkpointing configuration.
 	    use_parallel_residual (`bool`, *optional*, defaults to `True`):
 	        Whether to use a parallel residual connection in the attention layer.
+	    scan_layers (`bool`, *optional*, defaults to `False`):
+	        Whether to use the scan implementation for the layers. The layer weights are
+	        then stored stacked along a leading layer axis.
 	"""
 
 	model_type: str = "gpt_neox"
@@ -95,6 +98,7 @@ class GPTNeoXConfig(EasyDeLBaseConfig):
 		rope_scaling=None,
 		attention_bias=True,
 		gradient_checkpointing=EasyDeLGradientCheckPointers.NONE,
+		scan_layers: bool = False,
 		**kwargs,
 	):
 		self.vocab_size = vocab_size
@@ -118,7 +122,10 @@ class GPTNeoXConfig(EasyDeLBaseConfig):
 		self.use_parallel_residual = use_parallel_residual
 		self.rope_scaling = rope_scaling
 		self.attention_bias = attention_bias
+		self.scan_layers = scan_layers
 		self.from_pt = False
+		# left unset so `GPTNeoXAttention` can tell an explicit choice from the default.
+		kwargs.setdefault("attn_mechanism", None)
 		super().__init__(bos_token_id=bos_token_id, eos_token_id=eos_token_id, **kwargs)
 
 	def get_partition_rules(self, *args, **kwargs):
@@ -127,8 +134,7 @@ class GPTNeoXConfig(EasyDeLBaseConfig):
 		Returns:
 		    `tp.Tuple[tp.Tuple[str, PartitionSpec]]`: The partition rules.
 		"""
-		return (
-			("wte/embedding", PartitionSpec("tp", ("fsdp", "sp"))),
+		layer_rules = (
 			("attention/w_qkv/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			("attention/w_qkv/bias", PartitionSpec(("fsdp", "sp"))),  # 1D for bias
 			("attention/wo/kernel", PartitionSpec("tp", ("fsdp", "sp"))),
@@ -139,6 +145,15 @@ class GPTNeoXConfig(EasyDeLBaseConfig):
 			("mlp/dense_4h_to_h/bias", PartitionSpec(("fsdp", "sp"))),  # 1D for bias
 			("post_attention_layernorm/(bias|scale)", PartitionSpec(None)),
 			("input_layernorm/(bias|scale)", PartitionSpec(None)),
+		)
+		if self.scan_layers:
+			# the blocks are stored stacked, so their states gain a leading layer axis.
+			layer_rules = tuple(
+				(rule, PartitionSpec(None, *spec)) for rule, spec in layer_rules
+			)
+		return (
+			("wte/embedding", PartitionSpec("tp", ("fsdp", "sp"))),
+			*layer_rules,
 			("transformer/final_layer_norm/(scale|bias)", PartitionSpec(None)),
 			("lm_head/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			(".*", PartitionSpec(None)),
@@ -20,6 +20,7 @@ import chex
 import jax
 from flax import nnx as nn
 from jax import numpy as jnp
+from jax.ad_checkpoint import checkpoint_name
 
 from easydel.infra.base_module import EasyDeLBaseModule
 from easydel.infra.factory import register_module
@@ -29,11 +30,20 @@ from easydel.infra.modeling_outputs import (
 )
 from easydel.infra.utils import (
 	ACT2FN,
+	ModuleCaches,
 	auto_remat,
 	control_mlp_sharding,
+	layer_at,
+	stack_layers,
+)
+from easydel.infra.etils import DEFAULT_ATTENTION_MECHANISM
+from easydel.layers.attention import (
+	AttentionMechanisms,
+	FlaxAttentionModule,
+	FlexibleAttentionModule,
 )
-from easydel.layers.attention import FlaxAttentionModule, FlexibleAttentionModule
 from easydel.layers.caching import TransformerCache, TransformerCacheView
+from easydel.layers.norms import fused_residual_layernorm
 from easydel.modules.gpt_neox.gpt_neox_configuration import (
 	GPTNeoXConfig as GPTNeoXConfig,
 )
@@ -55,10 +65,13 @@ class GPTNeoXAttention(FlaxAttentionModule):
 		self.precision = precision
 		self.rngs = rngs
 		self.head_dim = self.config.hidden_size // self.config.num_attention_heads
+		self.rotary_dim = int(self.head_dim * self.config.rotary_pct)
+		# the rotary only ever sees the leading `rotary_dim` lanes, which are split
+		# off in `__call__`, so it is built for exactly that width.
 		self.rotary = self.config.get_basic_rope(
 			dtype=dtype,
-			head_size=self.head_dim,
-			rotary_dim=int(self.head_dim * self.config.rotary_pct),
+			head_size=self.rotary_dim,
+			rotary_dim=self.rotary_dim,
 			base=self.config.rotary_emb_base,
 		)
 		self.query_key_value = nn.Linear(
@@ -77,6 +90,14 @@ class GPTNeoXAttention(FlaxAttentionModule):
 			precision=precision,
 			rngs=rngs,
 		)
+		attn_mechanism = self.config.attn_mechanism
+		if attn_mechanism is None:
+			# unset by the user; the tiled kernel keeps the (S, S) scores out of HBM
+			# on accelerators.
+			if self.head_dim in (64, 128) and jax.default_backend() in ("gpu", "tpu"):
+				attn_mechanism = AttentionMechanisms.FLASH_ATTN2
+			else:
+				attn_mechanism = DEFAULT_ATTENTION_MECHANISM
 		self.attention_performer = FlexibleAttentionModule(
 			use_sharding_constraint=self.config.use_sharding_constraint,
 			num_q_heads=self.config.num_attention_heads,
@@ -86,7 +107,7 @@ class GPTNeoXAttention(FlaxAttentionModule):
 			shard_attention_computation=self.config.shard_attention_computation,
 			precision=self.precision,
 			force_float32_tpu=True,
-			attn_mechanism=self.config.attn_mechanism,
+			attn_mechanism=attn_mechanism,
 			dtype=self.config.attn_dtype,
 			softmax_dtype=self.config.attn_softmax_dtype,
 			partition_axis=self.config.partition_axis,
@@ -96,11 +117,6 @@ class GPTNeoXAttention(FlaxAttentionModule):
 			base_config=self.config,
 		)
 
-	def _split_heads(self, hidden_states):
-		return hidden_states.reshape(
-			hidden_states.shape[:2] + (self.config.num_attention_heads, self.head_dim)
-		)
-
 	def __call__(
 		self,
 		hidden_states: chex.Array,
@@ -112,21 +128,26 @@ class GPTNeoXAttention(FlaxAttentionModule):
 		output_attentions: bool = False,
 		frequencies: tp.Optional[chex.Array] = None,
 	):
-		query, key, value = jnp.split(
-			self.query_key_value(hidden_states),
-			indices_or_sections=3,
-			axis=-1,
+		# the fused projection is laid out per head as `(heads, 3, head_dim)`, so a
+		# single reshape exposes query / key / value as views along one axis.
+		qkv = checkpoint_name(self.query_key_value(hidden_states), "qkv_out").reshape(
+			*hidden_states.shape[:2],
+			self.config.num_attention_heads,
+			3,
+			self.head_dim,
 		)
-
-		query = self._split_heads(query)
-		key = self._split_heads(key)
-		value = self._split_heads(value)
-		query, key = self.rotary(
+		query, key, value = qkv[..., 0, :], qkv[..., 1, :], qkv[..., 2, :]
+		query_rot, key_rot = self.rotary(
 			positions=position_ids,
-			query=query,
-			key=key,
+			query=query[..., : self.rotary_dim],
+			key=key[..., : self.rotary_dim],
 			frequencies=frequencies,
 		)
+		if self.rotary_dim != self.head_dim:
+			query = jnp.concatenate([query_rot, query[..., self.rotary_dim :]], axis=-1)
+			key = jnp.concatenate([key_rot, key[..., self.rotary_dim :]], axis=-1)
+		else:
+			query, key = query_rot, key_rot
 
 		(
 			key,
@@ -159,7 +180,7 @@ class GPTNeoXAttention(FlaxAttentionModule):
 		attn_output = self.shard_attention_prod(
 			self._merge_heads(attentions.attention_outputs)
 		)
-		attn_output = self.dense(attn_output)
+		attn_output = checkpoint_name(self.dense(attn_output), "attn_out")
 		outputs = (
 			(attn_output, attentions.attention_weights)
 			if output_attentions
@@ -200,12 +221,14 @@ class GPTNeoXMlp(nn.Module):
 		)
 		self.act = ACT2FN[self.config.hidden_act]
 
+	@jax.named_scope("easydel-gpt-neox-mlp")
 	def __call__(self, hidden_states):
-		hidden_states = control_mlp_sharding(
-			hidden_states,
-			self.config.partition_axis,
-		)
-		return self.dense_4h_to_h(self.act(self.dense_h_to_4h(hidden_states)))
+		# inputs arrive sharded from `GPTNeoXBlock`, which constrains them once.
+		# bias and activation are left as the direct consumers of the first matmul so
+		# XLA folds them into its epilogue; the linears stay modules so quantized
+		# replacements keep working.
+		hidden_states = checkpoint_name(self.dense_h_to_4h(hidden_states), "mlp_up")
+		return checkpoint_name(self.dense_4h_to_h(self.act(hidden_states)), "mlp_down")
 
 
 class GPTNeoXBlock(nn.Module):
@@ -247,14 +270,14 @@ class GPTNeoXBlock(nn.Module):
 			param_dtype=param_dtype,
 			rngs=rngs,
 		)
-		self.attention = GPTNeoXAttention(
+		self.attention = attn_block(
 			config=config,
 			dtype=dtype,
 			param_dtype=param_dtype,
 			precision=precision,
 			rngs=rngs,
 		)
-		self.mlp = GPTNeoXMlp(
+		self.mlp = mlp_block(
 			config=config,
 			dtype=dtype,
 			param_dtype=param_dtype,
@@ -273,6 +296,8 @@ class GPTNeoXBlock(nn.Module):
 		output_attentions: bool = False,
 		frequencies: tp.Optional[chex.Array] = None,
 	):
+		# one constraint per layer; SPMD propagates it to both norms and the MLP.
+		hidden_states = control_mlp_sharding(hidden_states, self.config.partition_axis)
 		attn_out = self.attention(
 			self.input_layernorm(hidden_states),
 			attention_mask,
@@ -288,10 +313,15 @@ class GPTNeoXBlock(nn.Module):
 			mlp = self.mlp(self.post_attention_layernorm(hidden_states))
 			hidden_states = mlp + hidden_states + attn
 		else:
-			hidden_states = attn + hidden_states
-			hidden_states = (
-				self.mlp(self.post_attention_layernorm(hidden_states)) + hidden_states
+			hidden_states, normed = fused_residual_layernorm(
+				hidden_states,
+				attn,
+				self.post_attention_layernorm.scale.value,
+				self.post_attention_layernorm.bias.value,
+				epsilon=self.post_attention_layernorm.epsilon,
+				dtype=self.dtype,
 			)
+			hidden_states = self.mlp(normed) + hidden_states
 		return (hidden_states,) + attn_out[1:]
 
 
@@ -326,16 +356,30 @@ class GPTNeoXModel(EasyDeLBaseModule):
 			rngs=rngs,
 		)
 		self.emb_dropout = nn.Dropout(config.hidden_dropout, rngs=rngs)
-		self.layers = [
-			GPTNeoXBlock(
-				config=config,
-				dtype=dtype,
-				param_dtype=param_dtype,
-				precision=precision,
-				rngs=rngs,
+		if config.scan_layers:
+			# stored stacked, so the scan runs over the weights as they are.
+			self.layers = stack_layers(
+				lambda rngs: GPTNeoXBlock(
+					config=config,
+					dtype=dtype,
+					param_dtype=param_dtype,
+					precision=precision,
+					rngs=rngs,
+				),
+				config.num_hidden_layers,
+				rngs,
 			)
-			for i in range(config.num_hidden_layers)
-		]
+		else:
+			self.layers = [
+				GPTNeoXBlock(
+					config=config,
+					dtype=dtype,
+					param_dtype=param_dtype,
+					precision=precision,
+					rngs=rngs,
+				)
+				for i in range(config.num_hidden_layers)
+			]
 		self.final_layer_norm = nn.LayerNorm(
 			config.hidden_size,
 			epsilon=self.config.layer_norm_eps,
@@ -347,11 +391,38 @@ class GPTNeoXModel(EasyDeLBaseModule):
 	@functools.cached_property
 	def frequencies(self):
 		head_dim = self.config.hidden_size // self.config.num_attention_heads
-		return self.config.get_basic_frequencies(
+		frequencies = self.config.get_basic_frequencies(
 			head_size=head_dim,
 			rotary_dim=int(head_dim * self.config.rotary_pct),
 			base=self.config.rotary_emb_base,
 		)
+		# cast once to the compute dtype; concrete even if first read under a trace.
+		with jax.ensure_compile_time_eval():
+			return ModuleCaches(frequencies.value.astype(self.dtype))
+
+	def _scan_layers(
+		self,
+		hidden_states: chex.Array,
+		position_ids: chex.Array,
+		**kwargs,
+	) -> chex.Array:
+		"""Runs the stacked blocks as one `lax.scan` body."""
+		graphdef, params, others = nn.split(self.layers, nn.Param, ...)
+
+		# masks and frequencies are closed over as scan invariants. `position_ids`
+		# rides in the carry because the rope kernel gathers with it under
+		# `ensure_compile_time_eval`, where only tracers of the scan body may appear.
+		def body(carry, params):
+			hidden_states, position_ids = carry
+			block = nn.merge(graphdef, params, others)
+			hidden_states = block(
+				hidden_states=hidden_states,
+				position_ids=position_ids,
+				**kwargs,
+			)[0]
+			return (hidden_states, position_ids), None
+
+		return jax.lax.scan(body, (hidden_states, position_ids), params)[0][0]
 
 	def __call__(
 		self,
@@ -366,53 +437,92 @@ class GPTNeoXModel(EasyDeLBaseModule):
 		output_hidden_states: bool = False,
 		return_dict: bool = True,
 	):
-		all_attentions = () if output_attentions else None
-		all_hidden_states = () if output_hidden_states else None
+		all_attentions = [] if output_attentions else None
+		all_hidden_states = [] if output_hidden_states else None
 		if (input_ids is None) ^ (inputs_embeds is not None):
 			raise ValueError(
 				"You cannot specify both input_ids and inputs_embeds at the same time, and must specify either one"
 			)
 		if inputs_embeds is None:
-			inputs_embeds = self.embed_in(input_ids.astype("i4"))
+			# ids are expected as int32 already; the lookup takes any integer dtype.
+			inputs_embeds = self.embed_in(input_ids)
 
 		batch_size, sequence_length, _ = inputs_embeds.shape
-		if attention_mask is None:
-			attention_mask = jnp.ones((batch_size, sequence_length), "i4")
-		if position_ids is None:
-			position_ids = jnp.broadcast_to(
-				jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
-				(batch_size, sequence_length),
-			).astype(jnp.int32)
-
+		# shapes are static, so this check costs nothing in the compiled step.
 		assert (
 			sequence_length <= self.config.max_position_embeddings
 		), f"Maximum Position Embedding Reached ! (Excepted <= {self.config.max_position_embeddings} got {sequence_length})"
+		if position_ids is None:
+			if attention_mask is None:
+				# no padding, so positions are a plain range rather than a cumsum.
+				position_ids = jnp.broadcast_to(
+					jnp.arange(sequence_length, dtype=jnp.int32),
+					(batch_size, sequence_length),
+				)
+			else:
+				position_ids = jnp.broadcast_to(
+					jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
+					(batch_size, sequence_length),
+				).astype(jnp.int32)
+		if attention_mask is None:
+			attention_mask = jnp.ones((batch_size, sequence_length), "i4")
 
 		hidden_states = self.emb_dropout(
 			inputs_embeds + extra_embedding if extra_embedding is not None else inputs_embeds
 		)
 
+		# read once so every layer shares the same loop-invariant constants. They stay
+		# wrapped in `ModuleCaches` (never differentiated, unwrapped by the consumers),
+		# which keeps them intact when the call is traced by `implicit`.
+		causal_mask = self.causal_mask
+		frequencies = self.frequencies
+		if (
+			self.config.scan_layers
+			and past_key_values is None
+			and not output_attentions
+			and not output_hidden_states
+		):
+			hidden_states = self._scan_layers(
+				hidden_states,
+				attention_mask=attention_mask,
+				position_ids=position_ids,
+				segment_ids=segment_ids,
+				causal_mask=causal_mask.value,
+				frequencies=frequencies.value,
+			)
+			hidden_states = self.final_layer_norm(hidden_states)
+			if return_dict:
+				return FlaxBaseModelOutput(last_hidden_state=hidden_states)
+			return (hidden_states,)
+
 		if past_key_values is None:
-			past_key_values = TransformerCache.init_empty(len(self.layers))
+			past_key_values = TransformerCache.init_empty(self.config.num_hidden_layers)
 
-		for idx, block in enumerate(self.layers):
+		for idx in range(self.config.num_hidden_layers):
+			if self.config.scan_layers:
+				block = layer_at(self.layers, idx)
+			else:
+				block = self.layers[idx]
 			if output_hidden_states:
-				all_hidden_states += (hidden_states,)
+				all_hidden_states.append(hidden_states)
 			hidden_states, attn_weight = block(
 				hidden_states=hidden_states,
 				attention_mask=attention_mask,
 				position_ids=position_ids,
 				cache_view=past_key_values.views[idx],
 				segment_ids=segment_ids,
-				causal_mask=self.causal_mask,
-				frequencies=self.frequencies,
+				causal_mask=causal_mask,
+				frequencies=frequencies,
 				output_attentions=output_attentions,
 			)
 			if output_attentions:
-				all_attentions += (attn_weight,)
+				all_attentions.append(attn_weight)
 		hidden_states = self.final_layer_norm(hidden_states)
 		if output_hidden_states:
-			all_hidden_states += (hidden_states,)
+			all_hidden_states.append(hidden_states)
+			all_hidden_states = tuple(all_hidden_states)
+		if output_attentions:
+			all_attentions = tuple(all_attentions)
 
 		outputs = (
 			hidden_states,
@@ -424,6 +534,7 @@ class GPTNeoXModel(EasyDeLBaseModule):
 				last_hidden_state=hidden_states,
 				hidden_states=outputs[1],
 				attentions=outputs[2],
+				past_key_values=past_key_values,
 			)
 
 		return tuple([v for v in outputs if v is not None])
@@ -459,14 +570,17 @@ class GPTNeoXForCausalLM(EasyDeLBaseModule):
 			precision=precision,
 			rngs=rngs,
 		)
-		self.lm_head = nn.Linear(
-			config.hidden_size,
-			config.vocab_size,
-			use_bias=False,
-			dtype=dtype,
-			param_dtype=param_dtype,
-			rngs=rngs,
-		)
+		# tied logits are read straight off `embed_in`, so no head is allocated.
+		self.lm_head = None
+		if not config.tie_word_embeddings:
+			self.lm_head = nn.Linear(
+				config.hidden_size,
+				config.vocab_size,
+				use_bias=False,
+				dtype=dtype,
+				param_dtype=param_dtype,
+				rngs=rngs,
+			)
 
 	def __call__(
 		self,
@@ -496,8 +610,9 @@ class GPTNeoXForCausalLM(EasyDeLBaseModule):
 		hidden_states = outputs[0]
 
 		if self.config.tie_word_embeddings:
-			self.lm_head.kernel.value = self.gpt_neox.embed_in.embedding.value.T
-			lm_logits = self.lm_head(hidden_states)
+			# `attend` contracts on the feature axis without transposing the table,
+			# and serves both the float table and an int8 `Embed8bit` one.
+			lm_logits = self.gpt_neox.embed_in.attend(hidden_states)
 		else:
 			lm_logits = self.lm_head(hidden_states)
 
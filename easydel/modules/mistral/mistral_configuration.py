@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import math
 import typing as tp
 
 from jax.sharding import PartitionSpec
@@ -81,10 +82,26 @@ class MistralConfig(EasyDeLBaseConfig):
 	        Whether to use the scan implementation for the MLP.
 	    scan_mlp_chunk_size (`int`, *optional*, defaults to 1024):
 	        The chunk size to use when scanning the MLP.
-	    bits (`int`, *optional*):
-	        The number of bits to quantize the model to.
+	    bits (`int` or `"fp8"`, *optional*):
+	        The number of bits to quantize the model to. With `"fp8"`, `from_pretrained`
+	        stores the linear projections as `LinearFP8` (float8 e4m3 kernels with
+	        per-channel scales computed once at load).
 	    attention_bias (`bool`, *optional*, defaults to `False`):
 	        Whether to use bias in the attention layer.
+	    scan_layers (`bool`, *optional*, defaults to `False`):
+	        Whether to use the scan implementation for the layers. The layer weights are
+	        then stored stacked along a leading layer axis.
+	    gradient_checkpointing_scan_groups (`int`, *optional*):
+	        Number of layers per checkpointed group when `scan_layers` is combined with
+	        gradient checkpointing. Defaults to the largest divisor of
+	        `num_hidden_layers` that is at most its square root.
+	    use_fused_rmsnorm_matmul (`bool`, *optional*, defaults to `False`):
+	        Whether to run `input_layernorm` -> `qkv_proj` and `post_attention_layernorm`
+	        -> `gate_up_proj` through the fused Pallas RMSNorm + matmul kernel on TPU, so
+	        the normalized hidden states are never written to HBM.
+	    offload_aux_outputs (`bool`, *optional*, defaults to `False`):
+	        Whether to move the hidden states and attention weights collected for
+	        `output_hidden_states` / `output_attentions` into pinned host memory.
 	"""
 
 	model_type: str = "mistral"
@@ -115,8 +132,12 @@ class MistralConfig(EasyDeLBaseConfig):
 		attention_dropout: float = 0.0,
 		use_scan_mlp: bool = False,
 		scan_mlp_chunk_size: int = 1024,
-		bits: tp.Optional[int] = None,
+		bits: tp.Optional[tp.Union[int, tp.Literal["fp8"]]] = None,
 		attention_bias: bool = False,
+		scan_layers: bool = False,
+		gradient_checkpointing_scan_groups: tp.Optional[int] = None,
+		use_fused_rmsnorm_matmul: bool = False,
+		offload_aux_outputs: bool = False,
 		**kwargs,
 	):
 		self.vocab_size = vocab_size
@@ -145,6 +166,17 @@ class MistralConfig(EasyDeLBaseConfig):
 		self.scan_mlp_chunk_size = scan_mlp_chunk_size
 		self.attention_bias = attention_bias
 		self.attention_dropout = attention_dropout
+		self.scan_layers = scan_layers
+		if gradient_checkpointing_scan_groups is None:
+			# `nested_scan` needs equal groups, so take a divisor of the depth.
+			gradient_checkpointing_scan_groups = max(
+				size
+				for size in range(1, math.isqrt(num_hidden_layers) + 1)
+				if num_hidden_layers % size == 0
+			)
+		self.gradient_checkpointing_scan_groups = gradient_checkpointing_scan_groups
+		self.use_fused_rmsnorm_matmul = use_fused_rmsnorm_matmul
+		self.offload_aux_outputs = offload_aux_outputs
 
 		super().__init__(
 			pad_token_id=pad_token_id,
@@ -163,18 +195,22 @@ class MistralConfig(EasyDeLBaseConfig):
 		Returns:
 		    `tp.Tuple[tp.Tuple[str, PartitionSpec]]`: The partition rules.
 		"""
-		return (
-			("model/embed_tokens/embedding", PartitionSpec("tp", ("fsdp", "sp"))),
-			(
-				"self_attn/(q_proj|k_proj|v_proj)/kernel",
-				PartitionSpec(("fsdp", "sp"), "tp"),
-			),
+		layer_rules = (
+			("self_attn/qkv_proj/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			("self_attn/o_proj/kernel", PartitionSpec("tp", ("fsdp", "sp"))),
-			("mlp/gate_proj/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
+			("mlp/gate_up_proj/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			("mlp/down_proj/kernel", PartitionSpec("tp", ("fsdp", "sp"))),
-			("mlp/up_proj/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			("input_layernorm/kernel", PartitionSpec(None)),
 			("post_attention_layernorm/kernel", PartitionSpec(None)),
+		)
+		if self.scan_layers:
+			# the layers are stored stacked, so their states gain a leading layer axis.
+			layer_rules = tuple(
+				(rule, PartitionSpec(None, *spec)) for rule, spec in layer_rules
+			)
+		return (
+			("model/embed_tokens/embedding", PartitionSpec("tp", ("fsdp", "sp"))),
+			*layer_rules,
 			("model/norm/kernel", PartitionSpec(None)),
 			("lm_head/kernel", PartitionSpec(("fsdp", "sp"), "tp")),
 			(".*", PartitionSpec(None)),
@@ -18,12 +18,15 @@ import typing as tp
 
 import chex
 import jax
+from eformer.escale import with_sharding_constraint
 from flax import nnx as nn
 from jax import numpy as jnp
+from jax.sharding import PartitionSpec
 
 from easydel.infra.base_module import (
 	EasyDeLBaseModule,
 )
+from easydel.infra.etils import EasyDeLGradientCheckPointers
 from easydel.infra.factory import register_module
 from easydel.infra.modeling_outputs import (
 	FlaxBaseModelOutput,
@@ -36,10 +39,14 @@ from easydel.infra.utils import (
 	block_wise_ffn,
 	control_mlp_sharding,
 	get_dot_general_by_bits,
+	layer_at,
+	nested_scan,
+	offload_to_host,
+	stack_layers,
 )
 from easydel.layers.attention import FlaxAttentionModule, FlexibleAttentionModule
 from easydel.layers.caching import TransformerCache, TransformerCacheView
-from easydel.layers.norms import RMSNorm
+from easydel.layers.norms import RMSNorm, rms_norm_matmul
 from easydel.modules.mistral.mistral_configuration import (
 	MistralConfig,
 )
@@ -48,6 +55,19 @@ from easydel.utils.helpers import get_logger
 logger = get_logger(__name__)
 
 
+def _fused_linears(config: MistralConfig):
+	"""Fused projections and the `(torch linear, out features)` pairs they pack."""
+	q_size = config.num_attention_heads * config.head_dim
+	kv_size = config.num_key_value_heads * config.head_dim
+	return {
+		"gate_up_proj": (
+			("gate_proj", config.intermediate_size),
+			("up_proj", config.intermediate_size),
+		),
+		"qkv_proj": (("q_proj", q_size), ("k_proj", kv_size), ("v_proj", kv_size)),
+	}
+
+
 class MistralMLP(nn.Module):
 	def __init__(
 		self,
@@ -72,9 +92,10 @@ class MistralMLP(nn.Module):
 			rngs=rngs,
 			**get_dot_general_by_bits(config.bits, config.easy_method),
 		)
-		self.gate_proj = linear_class(
+		# gate and up projections share one matmul; the kernel is `[gate | up]`.
+		self.gate_up_proj = linear_class(
 			config.hidden_size,
-			config.intermediate_size,
+			2 * config.intermediate_size,
 			rngs=rngs,
 		)
 		self.down_proj = linear_class(
@@ -82,18 +103,20 @@ class MistralMLP(nn.Module):
 			config.hidden_size,
 			rngs=rngs,
 		)
-		self.up_proj = linear_class(
-			config.hidden_size,
-			config.intermediate_size,
-			rngs=rngs,
-		)
 		self.act_fn = ACT2FN[self.config.hidden_act]
 
-	def __call__(self, hidden_states: jnp.ndarray) -> jnp.ndarray:
+	def __call__(
+		self,
+		hidden_states: jnp.ndarray,
+		norm: tp.Optional[RMSNorm] = None,
+	) -> jnp.ndarray:
 		hidden_states = control_mlp_sharding(hidden_states, self.config.partition_axis)
-		return self.down_proj(
-			self.act_fn(self.gate_proj(hidden_states)) * self.up_proj(hidden_states)
-		)
+		if norm is not None:
+			gate_up = rms_norm_matmul(hidden_states, norm, self.gate_up_proj)
+		else:
+			gate_up = self.gate_up_proj(hidden_states)
+		gate, up = jnp.split(gate_up, 2, axis=-1)
+		return self.down_proj(self.act_fn(gate) * up)
 
 
 class MistralAttention(FlaxAttentionModule):
@@ -130,19 +153,10 @@ class MistralAttention(FlaxAttentionModule):
 			precision=precision,
 			**get_dot_general_by_bits(config.bits, config.easy_method),
 		)
-		self.q_proj = linear_class(
-			config.hidden_size,
-			config.num_attention_heads * self.head_dim,
-			rngs=rngs,
-		)
-		self.k_proj = linear_class(
+		# query, key and value share one matmul; the kernel is `[q | k | v]`.
+		self.qkv_proj = linear_class(
 			config.hidden_size,
-			config.num_key_value_heads * self.head_dim,
-			rngs=rngs,
-		)
-		self.v_proj = linear_class(
-			config.hidden_size,
-			config.num_key_value_heads * self.head_dim,
+			(config.num_attention_heads + 2 * config.num_key_value_heads) * self.head_dim,
 			rngs=rngs,
 		)
 		self.o_proj = linear_class(
@@ -180,12 +194,19 @@ class MistralAttention(FlaxAttentionModule):
 		output_attentions: bool = False,
 		fcm_mask: tp.Optional[chex.Array] = None,
 		frequencies: tp.Optional[chex.Array] = None,
+		norm: tp.Optional[RMSNorm] = None,
 	):
 		batch_size, sequence_length = hidden_states.shape[:2]
-		query_states, key_states, value_states = (
-			self.q_proj(hidden_states),
-			self.k_proj(hidden_states),
-			self.v_proj(hidden_states),
+		q_size = self.config.num_attention_heads * self.head_dim
+		kv_size = self.config.num_key_value_heads * self.head_dim
+		if norm is not None:
+			qkv = rms_norm_matmul(hidden_states, norm, self.qkv_proj)
+		else:
+			qkv = self.qkv_proj(hidden_states)
+		query_states, key_states, value_states = jnp.split(
+			qkv,
+			[q_size, q_size + kv_size],
+			axis=-1,
 		)
 
 		query_states = query_states.reshape(
@@ -320,9 +341,12 @@ class MistralDecoderLayer(nn.Module):
 		fcm_mask: tp.Optional[chex.Array] = None,
 		frequencies: tp.Optional[chex.Array] = None,
 	):
-		residual = hidden_states
+		# pin the residual stream to the batch / sequence / hidden-state axes at
+		# every layer boundary so the partitioner never re-lays it out in between.
+		hidden_states = control_mlp_sharding(hidden_states, self.config.partition_axis)
+		fused = self.config.use_fused_rmsnorm_matmul
 		attention_output = self.self_attn(
-			self.input_layernorm(hidden_states),
+			hidden_states if fused else self.input_layernorm(hidden_states),
 			attention_mask,
 			position_ids,
 			causal_mask,
@@ -331,22 +355,24 @@ class MistralDecoderLayer(nn.Module):
 			output_attentions,
 			fcm_mask,
 			frequencies,
+			self.input_layernorm if fused else None,
 		)
+		hidden_states = hidden_states + attention_output[0]
 
-		hidden_states = attention_output[0] + residual
-		ffd_inp = self.post_attention_layernorm(hidden_states)
+		if fused:
+			mlp = functools.partial(self.mlp, norm=self.post_attention_layernorm)
+		else:
+			mlp = lambda x: self.mlp(self.post_attention_layernorm(x))  # noqa: E731
 		if self.config.use_scan_mlp:
-			feed_forward_hidden_states = block_wise_ffn(
-				self.mlp, ffd_inp, self.config.scan_mlp_chunk_size
+			hidden_states = hidden_states + block_wise_ffn(
+				mlp, hidden_states, self.config.scan_mlp_chunk_size
 			)
 		else:
-			feed_forward_hidden_states = self.mlp(ffd_inp)
+			hidden_states = hidden_states + mlp(hidden_states)
 
-		hidden_states = hidden_states + feed_forward_hidden_states
-		outputs = (hidden_states,)
 		if output_attentions:
-			outputs += (attention_output[1],)
-		return outputs
+			return hidden_states, attention_output[1]
+		return (hidden_states,)
 
 
 @register_module(
@@ -356,6 +382,10 @@ class MistralDecoderLayer(nn.Module):
 	embedding_layer_names=["embed_tokens"],
 )
 class MistralModel(EasyDeLBaseModule):
+	@property
+	def _fused_linears(self):
+		return _fused_linears(self.config)
+
 	def __init__(
 		self,
 		config: MistralConfig,
@@ -381,16 +411,30 @@ class MistralModel(EasyDeLBaseModule):
 			rngs=rngs,
 		)
 
-		self.layers = [
-			MistralDecoderLayer(
-				config=config,
-				dtype=dtype,
-				param_dtype=param_dtype,
-				precision=precision,
-				rngs=rngs,
+		if config.scan_layers:
+			# stored stacked, so the scan runs over the weights as they are.
+			self.layers = stack_layers(
+				lambda rngs: MistralDecoderLayer(
+					config=config,
+					dtype=dtype,
+					param_dtype=param_dtype,
+					precision=precision,
+					rngs=rngs,
+				),
+				config.num_hidden_layers,
+				rngs,
 			)
-			for i in range(self.config.num_hidden_layers)
-		]
+		else:
+			self.layers = [
+				MistralDecoderLayer(
+					config=config,
+					dtype=dtype,
+					param_dtype=param_dtype,
+					precision=precision,
+					rngs=rngs,
+				)
+				for i in range(self.config.num_hidden_layers)
+			]
 		self.norm = RMSNorm(
 			config.hidden_size,
 			eps=config.rms_norm_eps,
@@ -399,6 +443,51 @@ class MistralModel(EasyDeLBaseModule):
 			rngs=rngs,
 		)
 
+	def _scan_layers(
+		self,
+		hidden_states: chex.Array,
+		position_ids: chex.Array,
+		output_hidden_states: bool = False,
+		**kwargs,
+	) -> tp.Tuple[chex.Array, tp.Optional[chex.Array]]:
+		"""
+		Runs the stacked decoder layers as one `lax.scan` body.
+
+		Returns the last hidden states and, with `output_hidden_states`, each layer's
+		input stacked as `(num_hidden_layers, batch, seq, hidden)`.
+		"""
+		graphdef, params, others = nn.split(self.layers, nn.Param, ...)
+
+		# masks and frequencies are closed over as scan invariants, so nothing built
+		# from them is saved per layer. `position_ids` rides in the carry because the
+		# rope kernel gathers with it under `ensure_compile_time_eval`, where only
+		# tracers of the scan body may appear.
+		def body(carry, params):
+			hidden_states, position_ids = carry
+			block = nn.merge(graphdef, params, others)
+			layer_input = hidden_states if output_hidden_states else None
+			hidden_states = block(
+				hidden_states=hidden_states,
+				position_ids=position_ids,
+				**kwargs,
+			)[0]
+			return (hidden_states, position_ids), layer_input
+
+		if self.config.gradient_checkpointing != EasyDeLGradientCheckPointers.NONE:
+			(hidden_states, _), layer_inputs = nested_scan(
+				body,
+				(hidden_states, position_ids),
+				params,
+				group_size=self.config.gradient_checkpointing_scan_groups,
+			)
+		else:
+			(hidden_states, _), layer_inputs = jax.lax.scan(
+				body,
+				(hidden_states, position_ids),
+				params,
+			)
+		return hidden_states, layer_inputs
+
 	def __call__(
 		self,
 		input_ids: tp.Optional[chex.Array] = None,
@@ -426,24 +515,76 @@ class MistralModel(EasyDeLBaseModule):
 			sequence_length <= self.config.max_position_embeddings
 		), f"Maximum Position Embedding Reached ! (Excepted <= {self.config.max_position_embeddings} got {sequence_length})"
 
+		if position_ids is None:
+			if attention_mask is None:
+				# an all-ones mask makes the cumsum below collapse to `arange`.
+				position_ids = jnp.broadcast_to(
+					jnp.arange(sequence_length, dtype=jnp.int32),
+					(batch_size, sequence_length),
+				)
+			else:
+				position_ids = jnp.broadcast_to(
+					jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
+					(batch_size, sequence_length),
+				).astype(jnp.int32)
+
 		if attention_mask is None:
 			attention_mask = jnp.ones((batch_size, sequence_length), "i4")
 
-		if position_ids is None:
-			position_ids = jnp.broadcast_to(
-				jnp.clip(jnp.cumsum(attention_mask, axis=-1) - 1, a_min=0),
-				(batch_size, sequence_length),
-			).astype(jnp.int32)
-
 		if attention_mask.ndim == 2:
-			attention_mask = jnp.expand_dims(attention_mask, (1, 2))
+			attention_mask = attention_mask[:, None, None, :]
+
+		partition_axis = self.config.partition_axis
+		hidden_states_spec = PartitionSpec(
+			partition_axis.batch_axis,
+			partition_axis.sequence_axis,
+			partition_axis.hidden_state_axis,
+		)
+		attentions_spec = PartitionSpec(
+			partition_axis.batch_axis,
+			partition_axis.head_axis,
+			partition_axis.query_sequence_axis,
+			partition_axis.key_sequence_axis,
+		)
+		if self.config.offload_aux_outputs:
+			aux_output = offload_to_host
+		else:
+			aux_output = lambda x, partition_spec: x  # noqa: E731
 
 		hidden_states = inputs_embeds
+		if self.config.scan_layers and past_key_values is None and not output_attentions:
+			# the cache and attention weights need the unrolled loop below.
+			hidden_states, layer_inputs = self._scan_layers(
+				hidden_states,
+				attention_mask=attention_mask,
+				position_ids=position_ids,
+				output_hidden_states=output_hidden_states,
+				segment_ids=segment_ids,
+				causal_mask=self.causal_mask.value,
+				frequencies=self.frequencies.value,
+			)
+			hidden_states = self.norm(hidden_states)
+			if output_hidden_states:
+				all_hidden_states = (
+					*aux_output(layer_inputs, PartitionSpec(None, *hidden_states_spec)),
+					aux_output(hidden_states, hidden_states_spec),
+				)
+			if not return_dict:
+				return tuple(v for v in (hidden_states, all_hidden_states) if v is not None)
+			return FlaxBaseModelOutput(
+				last_hidden_state=hidden_states,
+				hidden_states=all_hidden_states,
+			)
+
 		if past_key_values is None:
-			past_key_values = TransformerCache.init_empty(len(self.layers))
-		for idx, block in enumerate(self.layers):
+			past_key_values = TransformerCache.init_empty(self.config.num_hidden_layers)
+		for idx in range(self.config.num_hidden_layers):
+			if self.config.scan_layers:
+				block = layer_at(self.layers, idx)
+			else:
+				block = self.layers[idx]
 			if output_hidden_states:
-				all_hidden_states += (hidden_states,)
+				all_hidden_states += (aux_output(hidden_states, hidden_states_spec),)
 
 			layer_outputs = block(
 				hidden_states=hidden_states,
@@ -458,12 +599,12 @@ class MistralModel(EasyDeLBaseModule):
 			hidden_states = layer_outputs[0]
 
 			if output_attentions:
-				all_attentions += (layer_outputs[1],)
+				all_attentions += (aux_output(layer_outputs[1], attentions_spec),)
 
 		hidden_states = self.norm(hidden_states)
 
 		if output_hidden_states:
-			all_hidden_states += (hidden_states,)
+			all_hidden_states += (aux_output(hidden_states, hidden_states_spec),)
 		outputs = (hidden_states, all_hidden_states, all_attentions, past_key_values)
 
 		if not return_dict:
@@ -484,6 +625,10 @@ class MistralModel(EasyDeLBaseModule):
 	embedding_layer_names=["embed_tokens"],
 )
 class MistralForCausalLM(EasyDeLBaseModule):
+	@property
+	def _fused_linears(self):
+		return _fused_linears(self.config)
+
 	def __init__(
 		self,
 		config: MistralConfig,
@@ -547,12 +692,26 @@ class MistralForCausalLM(EasyDeLBaseModule):
 		hidden_states = outputs[0]
 
 		if self.config.tie_word_embeddings:
-			# self.lm_head.kernel.value = self.model.embed_tokens.embedding.value.T
-			# lm_logits = self.lm_head(hidden_states)
-			lm_logits = jax.lax.dot_general(
+			# contract against the (vocab, hidden) table directly instead of its `.T`,
+			# and keep the logits vocab-sharded over the tensor-parallel axis.
+			lm_logits = jnp.einsum(
+				"btd,vd->btv",
 				hidden_states,
-				self.model.embed_tokens.embedding.value.T,
-				(((hidden_states.ndim - 1), (0,)), ((), ())),
+				self.model.embed_tokens.embedding.value,
+				precision=self.precision,
+			)
+			partition_axis = self.config.partition_axis
+			lm_logits = with_sharding_constraint(
+				lm_logits,
+				PartitionSpec(
+					partition_axis.batch_axis,
+					(
+						partition_axis.sequence_axis
+						if lm_logits.shape[1] != 1
+						else partition_axis.generation_query_sequence_axis
+					),
+					partition_axis.hidden_state_axis,
+				),
 			)
 		else:
 			lm_logits = self.lm_head(hidden_states)
@@ -575,6 +734,10 @@ class MistralForCausalLM(EasyDeLBaseModule):
 	embedding_layer_names=["embed_tokens"],
 )
 class MistralForSequenceClassification(EasyDeLBaseModule):
+	@property
+	def _fused_linears(self):
+		return _fused_linears(self.config)
+
 	def __init__(
 		self,
 		config: MistralConfig,
@@ -645,19 +808,24 @@ class MistralForSequenceClassification(EasyDeLBaseModule):
 
 		if self.config.pad_token_id is None and batch_size != 1:
 			raise ValueError("Cannot handle batch sizes > 1 if no padding token is defined.")
-		if self.config.pad_token_id is None:
-			sequence_lengths = -1
+		if self.config.pad_token_id is None or input_ids is None:
+			pooled_logits = logits[:, -1]
 		else:
-			if input_ids is not None:
-				sequence_lengths = (
-					jnp.argmax(jnp.equal(input_ids, self.config.pad_token_id).astype("i4"), -1)
-					- 1
-				)
-				sequence_lengths = sequence_lengths % input_ids.shape[-1]
-			else:
-				sequence_lengths = -1
-
-		pooled_logits = logits[jnp.arange(batch_size), sequence_lengths]
+			# index of the last non-pad token, which is right for both left and right
+			# padding, taken as one reduction instead of a cast + argmax.
+			sequence_lengths = jnp.max(
+				jnp.where(
+					jnp.not_equal(input_ids, self.config.pad_token_id),
+					jnp.arange(input_ids.shape[-1]),
+					0,
+				),
+				axis=-1,
+			)
+			pooled_logits = jnp.take_along_axis(
+				logits,
+				sequence_lengths[:, None, None],
+				axis=1,
+			).squeeze(1)
 
 		if not return_dict:
 			output = (pooled_logits,) + transformer_outputs[1:]
@@ -103,6 +103,15 @@ class TrainerOutput:
 	checkpoint_path: tp.Optional[str] = None
 
 
+# only `state` holds arrays; the rest rides along as static aux data, so the
+# output can cross `jit` / `tree.map` without tracing the mesh or paths.
+jax.tree_util.register_dataclass(
+	TrainerOutput,
+	data_fields=["state"],
+	meta_fields=["mesh", "last_save_file_name", "checkpoint_path"],
+)
+
+
 class BaseTrainerProtocol(metaclass=ABCMeta):
 	# Required attributes for all trainers
 	arguments: TrainingArguments
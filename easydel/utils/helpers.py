@@ -14,6 +14,7 @@
 
 
 import contextlib
+import functools
 import logging
 import os
 import sys
@@ -29,11 +30,6 @@ if tp.TYPE_CHECKING:
 	from flax.metrics.tensorboard import SummaryWriter
 else:
 	SummaryWriter = tp.Any
-try:
-	import wandb  # type: ignore
-except ModuleNotFoundError:
-	wandb = None
-
 
 _LOGGING_LEVELS = dict(
 	CRITICAL=50,
@@ -68,6 +64,13 @@ def get_logger(
 	# Set the logging level
 	logger.setLevel(level)
 
+	# loggers are process-wide singletons; reuse the handler from an earlier call
+	# instead of stacking a new one (and printing every record twice).
+	if logger.handlers:
+		for handler in logger.handlers:
+			handler.setLevel(level)
+		return logger
+
 	# Create a console handler
 	console_handler = logging.StreamHandler()
 	console_handler.setLevel(level)
@@ -122,29 +125,43 @@ def capture_time():
 logger = get_logger(__name__)
 
 
+# (upper bound in ms, divisor, unit, color) for `Timers._print_log`.
+_TIME_UNITS = (
+	(1000.0, 1.0, "ms", "\033[94m"),  # Blue
+	(60000.0, 1000.0, "sec", "\033[92m"),  # Green
+	(3600000.0, 60000.0, "min", "\033[93m"),  # Yellow
+	(float("inf"), 3600000.0, "hr", "\033[91m"),  # Red
+)
+
+
 class Timer:
 	def __init__(self, name):
 		self.name = name
-		self.elapsed = 0.0
+		# monotonic integer nanoseconds; converted to seconds only on readout.
+		self.elapsed_ns = 0
 		self.started = False
-		self.start_time = 0.0
+		self.start_time = 0
+
+	@property
+	def elapsed(self):
+		return self.elapsed_ns / 1e9
 
 	def start(self):
 		if self.started:
 			raise RuntimeError(f"Timer '{self.name}' is already running")
-		self.start_time = time.time()
+		self.start_time = time.perf_counter_ns()
 		self.started = True
 
 	def stop(self):
 		if not self.started:
 			raise RuntimeError(f"Timer '{self.name}' is not running")
-		self.elapsed += time.time() - self.start_time
+		self.elapsed_ns += time.perf_counter_ns() - self.start_time
 		self.started = False
 
 	def reset(self):
-		self.elapsed = 0.0
+		self.elapsed_ns = 0
 		self.started = False
-		self.start_time = 0.0
+		self.start_time = 0
 
 	def elapsed_time(self, reset=True):
 		if self.started:
@@ -167,6 +184,8 @@ class Timers:
 		self.timers = {}
 		self.use_wandb = use_wandb
 		self.tensorboard_writer = tensorboard_writer
+		# `wandb` is heavy to import, so it is only pulled in on the first write.
+		self._wandb = None
 
 	def __call__(self, name):
 		if name not in self.timers:
@@ -175,46 +194,49 @@ class Timers:
 
 	def write(self, names, iteration, normalizer=1.0, reset=False):
 		assert normalizer > 0.0
+		scale = 1.0 / normalizer
 		for name in names:
-			value = self.timers[name].elapsed_time(reset=reset) / normalizer
+			value = self.timers[name].elapsed_time(reset=reset) * scale
 
 			if self.tensorboard_writer:
 				self.tensorboard_writer.scalar(f"timers/{name}", value, iteration)
 
 			if self.use_wandb:
-				if wandb is None:
-					warnings.warn(
-						"`wandb` is not installed use `pip install wandb` (use_wandb=True will be ignored)",
-						stacklevel=1,
-					)
-					self.use_wandb = False
-				else:
-					wandb.log({f"timers/{name}": value}, step=iteration)
+				if self._wandb is None:
+					try:
+						import wandb  # type: ignore
+					except ModuleNotFoundError:
+						warnings.warn(
+							"`wandb` is not installed use `pip install wandb` (use_wandb=True will be ignored)",
+							stacklevel=1,
+						)
+						self.use_wandb = False
+						continue
+					self._wandb = wandb
+				self._wandb.log({f"timers/{name}": value}, step=iteration)
 
 	def log(self, names, normalizer=1.0, reset=True):
 		assert normalizer > 0.0
 
 		if isinstance(names, str):
 			names = [names]
+		scale = 1000.0 / normalizer  # seconds -> milliseconds, normalized
 		for name in names:
-			elapsed_time = self.timers[name].elapsed_time(reset=reset) * 1000.0 / normalizer
+			elapsed_time = self.timers[name].elapsed_time(reset=reset) * scale
 			self._print_log(name, elapsed_time)
 
 	def _print_log(self, name, elapsed_time):
-		if elapsed_time < 1000:
-			time_str = f"{elapsed_time:.4f} ms"
-			color = "\033[94m"  # Blue
-		elif elapsed_time < 60000:
-			time_str = f"{elapsed_time / 1000:.4f} sec"
-			color = "\033[92m"  # Green
-		elif elapsed_time < 3600000:
-			time_str = f"{elapsed_time / 60000:.4f} min"
-			color = "\033[93m"  # Yellow
-		else:
-			time_str = f"{elapsed_time / 3600000:.4f} hr"
-			color = "\033[91m"  # Red
-
-		logger.info(f"time took for {name} : {color}{time_str}\033[0m")
+		for threshold, divisor, unit, color in _TIME_UNITS:
+			if elapsed_time < threshold:
+				break
+		# %-style arguments, so nothing is formatted when INFO is disabled.
+		logger.info(
+			"time took for %s : %s%.4f %s\033[0m",
+			name,
+			color,
+			elapsed_time / divisor,
+			unit,
+		)
 
 	@contextlib.contextmanager
 	def timed(self, name, log=True, reset=True):
@@ -231,6 +253,7 @@ class Timers:
 				self._print_log(name, elapsed_time)
 
 
+@functools.lru_cache(maxsize=1)
 def get_cache_dir() -> Path:
 	home_dir = Path.home()
 	app_name = "easydel"
@@ -239,7 +262,7 @@ def get_cache_dir() -> Path:
 			Path(os.getenv("LOCALAPPDATA", home_dir / "AppData" / "Local")) / app_name
 		)
 	elif os.name == "posix":  # Linux and macOS
-		if "darwin" in os.sys.platform:  # macOS
+		if sys.platform == "darwin":  # macOS
 			cache_dir = home_dir / "Library" / "Caches" / app_name
 		else:  # Linux
 			cache_dir = home_dir / ".cache" / app_name
@@ -267,7 +290,7 @@ def quiet(suppress_stdout=True, suppress_stderr=True):
 	  suppress_stdout (bool): Whether to suppress stdout
 	  suppress_stderr (bool): Whether to suppress stderr
 	Usage:
-	  with suppress_output():
+	  with quiet():
 	    # Code that generates unwanted output
 	    print("This won't be displayed")
 	Note:
@@ -276,8 +299,22 @@ def quiet(suppress_stdout=True, suppress_stderr=True):
 	"""
 	original_stdout = sys.stdout
 	original_stderr = sys.stderr
+	fds = [fd for fd, on in ((1, suppress_stdout), (2, suppress_stderr)) if on]
+	saved_fds = {}
+	devnull_fd = None
 
 	try:
+		# point the OS-level descriptors at /dev/null as well, so writes from C
+		# extensions (XLA, tokenizers) are dropped by the kernel. stdio dup2 is
+		# fragile on Windows, which keeps only the Python-level swap below.
+		if fds and os.name != "nt":
+			for stream in (original_stdout, original_stderr):
+				if stream is not None:
+					stream.flush()
+			devnull_fd = os.open(os.devnull, os.O_WRONLY)
+			for fd in fds:
+				saved_fds[fd] = os.dup(fd)
+				os.dup2(devnull_fd, fd)
 		if suppress_stdout:
 			sys.stdout = DummyStream()
 		if suppress_stderr:
@@ -289,3 +326,8 @@ def quiet(suppress_stdout=True, suppress_stderr=True):
 			sys.stdout = original_stdout
 		if suppress_stderr:
 			sys.stderr = original_stderr
+		for fd, saved_fd in saved_fds.items():
+			os.dup2(saved_fd, fd)
+			os.close(saved_fd)
+		if devnull_fd is not None:
+			os.close(devnull_fd)
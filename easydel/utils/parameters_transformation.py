@@ -195,6 +195,84 @@ def process_tensor(
 	return key_tuple, array
 
 
+def fuse_torch_linears(
+	state_dict: tp.Dict[str, tp.Any],
+	fused_linears: tp.Mapping[str, tp.Sequence[tp.Tuple[str, int]]],
+) -> tp.Dict[str, tp.Any]:
+	"""
+	Concatenates the torch weights of sibling linears (e.g. `gate_proj` and
+	`up_proj`) along their output axis into the fused linear that replaces them.
+
+	`fused_linears` maps each fused name to its `(part name, out features)` pairs
+	in concatenation order.
+	"""
+	torch = get_torch()
+	state_dict = dict(state_dict)
+	for fused, parts in fused_linears.items():
+		first = parts[0][0]
+		for key in [k for k in state_dict if k.endswith(f".{first}.weight")]:
+			prefix = key[: -len(f"{first}.weight")]
+			for suffix in ("weight", "bias"):
+				names = [f"{prefix}{part}.{suffix}" for part, _ in parts]
+				if all(name in state_dict for name in names):
+					state_dict[f"{prefix}{fused}.{suffix}"] = torch.cat(
+						[state_dict.pop(name) for name in names],
+						dim=0,
+					)
+	return state_dict
+
+
+def split_torch_linears(
+	state_dict: tp.Dict[str, tp.Any],
+	fused_linears: tp.Mapping[str, tp.Sequence[tp.Tuple[str, int]]],
+) -> tp.Dict[str, tp.Any]:
+	"""Inverse of `fuse_torch_linears`."""
+	for fused, parts in fused_linears.items():
+		sizes = [size for _, size in parts]
+		for key in [k for k in state_dict if f".{fused}." in k]:
+			prefix, suffix = key.split(f".{fused}.")
+			chunks = state_dict.pop(key).split(sizes, dim=0)
+			for (part, _), chunk in zip(parts, chunks):
+				state_dict[f"{prefix}.{part}.{suffix}"] = chunk
+	return state_dict
+
+
+def stack_layer_params(
+	params: tp.Dict[tuple, tp.Any],
+	stacked_layers: tp.Sequence[tuple],
+) -> tp.Dict[tuple, tp.Any]:
+	"""
+	Stacks the per-layer entries `(*path, idx, *name)` of a flat parameter dict
+	into one `(*path, *name)` array with a leading layer axis, for every `path` in
+	`stacked_layers` (block lists built with `stack_layers`).
+	"""
+	for path in stacked_layers:
+		depth = len(path)
+		layers = {}
+		for key in [k for k in params if k[:depth] == path and len(k) > depth]:
+			if isinstance(key[depth], int):
+				layers.setdefault(key[depth + 1 :], {})[key[depth]] = params.pop(key)
+		for name, arrays in layers.items():
+			params[path + name] = jnp.stack([arrays[idx] for idx in sorted(arrays)])
+	return params
+
+
+def unstack_layer_params(
+	params: tp.Dict[tuple, tp.Any],
+	stacked_layers: tp.Sequence[tuple],
+) -> tp.Dict[tuple, tp.Any]:
+	"""Inverse of `stack_layer_params`."""
+	for path in stacked_layers:
+		depth = len(path)
+		for key in [k for k in params if k[:depth] == path and len(k) > depth]:
+			array = params.pop(key)
+			if array is None:
+				continue
+			for idx in range(array.shape[0]):
+				params[path + (idx,) + key[depth:]] = array[idx]
+	return params
+
+
 def torch_dict_to_easydel_params(
 	state_dict: tp.Dict[str, tp.Any],
 	*,
@@ -208,6 +286,8 @@ def torch_dict_to_easydel_params(
 	remove_state_dict: bool = False,
 	lm_head_name: tp.Optional[str] = None,
 	uses_tie_word_embedding: bool = False,
+	fused_linears: tp.Optional[tp.Mapping[str, tp.Sequence[tp.Tuple[str, int]]]] = None,
+	stacked_layers: tp.Optional[tp.Sequence[tuple]] = None,
 	**kwargs,
 ) -> tp.Dict[str, tp.Any]:
 	"""
@@ -227,6 +307,8 @@ def torch_dict_to_easydel_params(
 	    remove_state_dict: Whether to delete state_dict after conversion
 	    lm_head_name: Name of language model head
 	    uses_tie_word_embedding: Whether model uses tied embeddings
+	    fused_linears: Fused linear names mapped to the torch linears they replace
+	    stacked_layers: Paths of the block lists stored stacked along a layer axis
 	    **kwargs: Additional arguments
 
 	Returns:
@@ -239,6 +321,9 @@ def torch_dict_to_easydel_params(
 	except ModuleNotFoundError:
 		_clear = gc.collect
 
+	if fused_linears:
+		state_dict = fuse_torch_linears(state_dict, fused_linears)
+
 	# Configuration dictionary
 	config = {
 		"embedding_layer_names": set(embedding_layer_names or []),
@@ -274,6 +359,15 @@ def torch_dict_to_easydel_params(
 					print(f"Error processing key {key}: {str(e)}")
 				pbar.update(1)
 
+		if stacked_layers:
+			# the per-layer keys match no shard function, so the stacks are sharded
+			# once they are assembled.
+			flax_dict = stack_layer_params(flax_dict, stacked_layers)
+			for path in stacked_layers:
+				for key in [k for k in flax_dict if k[: len(path)] == path]:
+					if shard_fns and key in shard_fns:
+						flax_dict[key] = shard_fns[key](flax_dict[key])
+
 		if remove_state_dict:
 			del state_dict
 			_clear()
@@ -285,8 +379,11 @@ def module_to_torch(module: EasyDeLBaseModule, dtype: jnp.dtype = jnp.float16):
 	if dtype is None:
 		dtype = module.param_dtype
 
-	graphtree = unflatten_dict(module.parameters)
-	model_parameters = flatten_dict(graphtree, sep=".")
+	parameters = unstack_layer_params(
+		dict(module.parameters),
+		getattr(module, "_stacked_layers", ()),
+	)
+	model_parameters = flatten_dict(unflatten_dict(parameters), sep=".")
 	torch_state_dict = {}
 	pbar = tqdm(
 		model_parameters.items(),
@@ -327,6 +424,9 @@ def module_to_torch(module: EasyDeLBaseModule, dtype: jnp.dtype = jnp.float16):
 		)
 
 		torch_state_dict[key] = tensor
+	fused_linears = getattr(module, "_fused_linears", None)
+	if fused_linears:
+		torch_state_dict = split_torch_linears(torch_state_dict, fused_linears)
 	return torch_state_dict
 
 
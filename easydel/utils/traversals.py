@@ -451,6 +451,9 @@ def recreate_meta_values(
 				value.type, nnx.RngKey
 			):
 				values[key].value = recreator.get_rng()
+			elif isinstance(value.type, type) and issubclass(value.type, nnx.Cache):
+				# derived from the params being replaced, so it is rebuilt by its owner.
+				values[key].value = None
 			else:
 				raise TypeError(f"Unexpected type {value.type} for key {key}")
 	except Exception as e:
@@ -555,9 +558,13 @@ def merge_model_and_tree(model: M, tree: dict) -> M:
 	Returns:
 	    nnx.Module: The updated nnx model with the attached parameter tree.
 	"""
+	from easydel.layers.quantization import LinearNF4
+
 	graphdef, graphstate = nnx.split(model)
 	graphstate = merge_state_and_tree(tree=tree, state=graphstate)
-	return nnx.merge(graphdef, graphstate)
+	model = nnx.merge(graphdef, graphstate)
+	LinearNF4.refresh_dequant_caches(model)
+	return model
 
 
 def specs_to_name_sharding(tree: tp.Dict, mesh: tp.Optional[Mesh] = None) -> tp.Dict:
@@ -49,29 +49,29 @@ def create_dataset():
 		streaming=False,
 	)
 
-	def to_ids(sample):
-		ids = TOKENIZER.apply_chat_template(
+	def to_ids(samples):
+		# one call over the whole batch lets the fast tokenizer vectorize it.
+		conversations = [
 			[
-				{"role": "user", "content": sample["prompt"]},
-				{"role": "assistant", "content": sample["response"]},
-			],
+				{"role": "user", "content": prompt},
+				{"role": "assistant", "content": response},
+			]
+			for prompt, response in zip(samples["prompt"], samples["response"])
+		]
+		return TOKENIZER.apply_chat_template(
+			conversations,
 			max_length=MAX_LENGTH,
 			padding="max_length",
-			return_tensors="jax",
+			return_tensors="np",
 			return_dict=True,
 			truncation=True,
 		)
-		input_ids = ids["input_ids"]
-		attention_mask = ids["attention_mask"]
-		ids["input_ids"] = input_ids.squeeze(0)  # [-MAX_LENGTH:]
-		ids["attention_mask"] = attention_mask.squeeze(0)  # [-MAX_LENGTH:]
-		return ids
 
 	return dataset.map(
 		to_ids,
-		# batched=False,
+		batched=True,
+		batch_size=1000,
 		remove_columns=["prompt", "response"],
-		# num_proc=os.cpu_count(),
 	)
 
 